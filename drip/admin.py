@@ -1,10 +1,8 @@
-import json
-
 from django import forms
 from django.contrib import admin
 from django.conf import settings
 
-from drip.models import Drip, SentDrip, QuerySetRule, DripSplitSubject, DripEmailTag
+from drip.models import Drip, SentDrip, QuerySetRule, DripSplitSubject, DripEmailTag, MailgunBatch
 from drip.drips import configured_message_classes, message_class_for
 from drip.utils import get_user_model
 
@@ -66,17 +64,12 @@ class DripAdmin(admin.ModelAdmin):
         """
         from django.shortcuts import render, get_object_or_404
 
+        from drip.timeline import Timeline
+
         drip = get_object_or_404(Drip, id=drip_id)
 
-        shifted_drips = []
-        seen_users = set()
-        for shifted_drip in drip.drip.walk(into_past=int(into_past), into_future=int(into_future)+1):
-            shifted_drip.prune()
-            shifted_drips.append({
-                'drip': shifted_drip,
-                'qs': shifted_drip.get_queryset().exclude(id__in=seen_users)
-            })
-            seen_users.update(shifted_drip.get_queryset().values_list('id', flat=True))
+        timeline = Timeline(drip.drip, into_past=int(into_past), into_future=int(into_future)+1)
+        shifted_drips = timeline.days(page=request.GET.get('page', 1))
 
         return render(request, 'drip/timeline.html', locals())
 
@@ -101,11 +94,26 @@ class DripAdmin(admin.ModelAdmin):
 
         return HttpResponse(html, content_type=mime)
 
+    def field_paths(self, request):
+        """
+        Return User lookup paths for the QuerySetRule inline, either one
+        relation level below `parent` or those starting with `q`.
+        """
+        from django.http import JsonResponse
+        from drip.utils import get_field_children, search_field_paths
+        User = get_user_model()
+
+        query = request.GET.get('q')
+        if query:
+            paths = search_field_paths(User, query)
+        else:
+            paths = get_field_children(User, request.GET.get('parent', ''))
+        return JsonResponse(paths, safe=False)
+
     def build_extra_context(self, extra_context):
-        from drip.utils import get_simple_fields
+        from django.core.urlresolvers import reverse
         extra_context = extra_context or {}
-        User = get_user_model()
-        extra_context['field_data'] = json.dumps(get_simple_fields(User))
+        extra_context['field_paths_url'] = reverse('admin:drip_field_paths')
         return extra_context
 
     def add_view(self, request, extra_context=None):
@@ -121,6 +129,9 @@ class DripAdmin(admin.ModelAdmin):
         urls = super(DripAdmin, self).get_urls()
         my_urls = patterns(
             '',
+            url(r'^field_paths/$',
+                self.av(self.field_paths),
+                name='drip_field_paths'),
             url(r'^(?P<drip_id>[\d]+)/timeline/(?P<into_past>[\d]+)/(?P<into_future>[\d]+)/$',
                 self.av(self.timeline),
                 name='drip_timeline'),
@@ -135,3 +146,23 @@ class SentDripAdmin(admin.ModelAdmin):
     list_display = [f.name for f in SentDrip._meta.fields]
     ordering = ['-id']
 admin.site.register(SentDrip, SentDripAdmin)
+
+
+def retry_batches(modeladmin, request, queryset):
+    for batch in queryset.exclude(status='accepted'):
+        batch.retry()
+retry_batches.short_description = "Post again on the next send"
+
+
+def mark_batches_accepted(modeladmin, request, queryset):
+    for batch in queryset.exclude(status='accepted'):
+        batch.mark_accepted()
+mark_batches_accepted.short_description = "Mark as sent by Mailgun"
+
+
+class MailgunBatchAdmin(admin.ModelAdmin):
+    list_display = ['id', 'drip', 'date', 'lastchanged', 'status', 'status_code']
+    list_filter = ['status']
+    ordering = ['-id']
+    actions = [retry_batches, mark_batches_accepted]
+admin.site.register(MailgunBatch, MailgunBatchAdmin)
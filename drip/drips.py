@@ -1,16 +1,23 @@
-import operator
 import functools
+import json
+import operator
+import smtplib
+import threading
 
 from django.conf import settings
-from django.db.models import Q
-from django.template import Context, Template
+from django.db import connections, transaction
+from django.template import Context
 from django.utils.importlib import import_module
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.utils.html import strip_tags
+from django.utils.six.moves import queue
 
-from drip.models import SentDrip
-from drip.utils import get_user_model
+from drip.models import SentDrip, MailgunBatch, EmailValidation
+from drip.utils import get_user_model, iterate_queryset, queryset_pages, get_related_lookups, LRUCache
 from drip import mailgun
+from drip.mime import MessageSkeleton, PreparedEmailMessage
+from drip.rendering import (
+    get_template, get_plain_template, get_template_skeleton, get_variable_paths)
 
 try:
     from django.utils.timezone import now as conditional_now
@@ -62,24 +69,59 @@ class DripMessage(object):
             self._context = Context({'user': self.user})
         return self._context
 
+    def render(self, source):
+        """
+        Renders the template `source` for this message, filling in the
+        slots of its TemplateSkeleton if the drip prerenders templates
+        and the message has no context of its own.
+        """
+        engine = self.drip_base.template_engine
+        if (self.drip_base.prerender_templates and engine == 'django' and
+                type(self).context is DripMessage.context):
+            skeleton = get_template_skeleton(source)
+            if skeleton is not None:
+                return skeleton.render(self.context)
+        return get_template(source, engine).render(self.context)
+
     @property
     def subject(self):
         if not self._subject:
-            self._subject = Template(self.drip_base.subject_template).render(self.context)
+            self._subject = self.render(self.drip_base.subject_template)
         return self._subject
 
+    @property
+    def body_source(self):
+        return self.drip_base.body_template
+
     @property
     def body(self):
         if not self._body:
-            self._body = Template(self.drip_base.body_template).render(self.context)
+            self._body = self.render(self.body_source)
         return self._body
 
     @property
     def plain(self):
         if not self._plain:
-            self._plain = strip_tags(self.body)
+            plain_template = None
+            if self.drip_base.template_engine == 'django':
+                plain_template, _ = get_plain_template(self.body_source)
+            if plain_template is None:
+                self._plain = strip_tags(self.body)
+            else:
+                self._plain = plain_template.render(self.context)
         return self._plain
 
+    @property
+    def is_html(self):
+        """
+        Whether the body has any markup, known up front unless only
+        rendered variables can add it.
+        """
+        has_markup = False
+        if self.drip_base.template_engine == 'django':
+            _, has_markup = get_plain_template(self.body_source)
+        return has_markup or len(self.plain) != len(self.body)
+
     @property
     def from_(self):
         if self.drip_base.from_email_name:
@@ -96,11 +138,156 @@ class DripMessage(object):
                 self.subject, self.plain, self.from_, [self.user.email])
 
             # check if there are html tags in the rendered template
-            if len(self.plain) != len(self.body):
+            if self.is_html:
                 self._message.attach_alternative(self.body, 'text/html')
         return self._message
 
 
+class BroadcastMessage(object):
+    """
+    Makes message instances for drips where every user gets the same
+    message: only the first one is rendered and serialized, the others
+    reuse it with nothing but the recipient changed.
+
+    Nothing is rendered before the first message is asked for, so that
+    it fails for that user only, like rendering any other message would.
+    """
+
+    def __init__(self, drip_base, MessageClass):
+        self.drip_base = drip_base
+        self.MessageClass = MessageClass
+        self.prototype = None
+        self.skeleton = None
+
+    def get_skeleton(self, message_instance):
+        if self.skeleton is None:
+            self.skeleton = MessageSkeleton(message_instance.message)
+            self.prototype = message_instance
+        return self.skeleton
+
+    def __call__(self, user):
+        return PreparedDripMessage(self, self.MessageClass(self.drip_base, user), user)
+
+
+class SkeletonMessage(object):
+    """
+    Makes message instances that are rendered per user as usual, but
+    whose email messages share a MessageSkeleton: what is the same for
+    every user is encoded once, for the first one, and only the subject
+    and text parts that depend on the user are filled in for the others.
+
+    Only the default message class is trusted to render nothing but what
+    its templates say; for others every subject and text part is filled in.
+    """
+
+    def __init__(self, drip_base, MessageClass):
+        self.drip_base = drip_base
+        self.MessageClass = MessageClass
+        self.prepared = False
+        self.skeleton = None
+
+    def renders_like_default(self):
+        return all(getattr(self.MessageClass, name) is getattr(DripMessage, name)
+                   for name in ('context', 'render', 'subject', 'body', 'plain'))
+
+    def uses_user(self, source):
+        if self.drip_base.template_engine != 'django' or not self.renders_like_default():
+            return True
+        return get_variable_paths(get_template(source)) != set()
+
+    def get_skeleton(self, message_instance):
+        if not self.prepared:
+            # rendering fails for this user only, and is tried again with
+            # the next one
+            email_message = message_instance.message
+            headers = ['To', 'Message-ID', 'Date']
+            if self.uses_user(self.drip_base.subject_template):
+                headers.append('Subject')
+            parts = ()
+            if self.uses_user(message_instance.body_source):
+                parts = ('text/plain', 'text/html') if message_instance.is_html else ('text/plain',)
+            try:
+                self.skeleton = MessageSkeleton(email_message, headers, parts)
+            except ValueError as e:
+                logging.warning("Not prebuilding messages of drip %s: %s" % (self.drip_base.drip_model.id, e))
+            self.prepared = True
+        return self.skeleton
+
+    def __call__(self, user):
+        return PreparedDripMessage(self, self.MessageClass(self.drip_base, user), user, variable=True)
+
+
+class PreparedDripMessage(object):
+    """
+    The message instance for a single user with a message built from the
+    skeleton of `factory`, taking subject and bodies from
+    `message_instance`, the one rendered for this user, if `variable`,
+    else from the one rendered once for everybody.
+    """
+
+    def __init__(self, factory, message_instance, user, variable=False):
+        self.factory = factory
+        self.message_instance = message_instance
+        self.user = user
+        self.variable = variable
+        self._message = None
+
+    @property
+    def rendered(self):
+        if self.variable or self.factory.prototype is None:
+            return self.message_instance
+        return self.factory.prototype
+
+    @property
+    def subject(self):
+        return self.rendered.subject
+
+    @property
+    def body(self):
+        return self.rendered.body
+
+    @property
+    def plain(self):
+        return self.rendered.plain
+
+    @property
+    def message(self):
+        if not self._message:
+            skeleton = self.factory.get_skeleton(self.message_instance)
+            if skeleton is None:
+                # messages can not be prebuilt for this drip
+                return self.message_instance.message
+            kwargs = {}
+            if self.variable:
+                kwargs['subject'] = self.subject
+                kwargs['body'] = self.plain
+                kwargs['alternatives'] = [(self.body, 'text/html')] if self.message_instance.is_html else []
+            self._message = PreparedEmailMessage(
+                skeleton, skeleton.email_message, [self.user.email], **kwargs)
+        return self._message
+
+
+class SentDripBuffer(object):
+    """
+    Collects unsaved SentDrips and writes them with a single
+    `bulk_create` every `batch_size` records.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.sent_drips = []
+
+    def add(self, sent_drip):
+        self.sent_drips.append(sent_drip)
+        if len(self.sent_drips) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.sent_drips:
+            SentDrip.objects.bulk_create(self.sent_drips)
+            self.sent_drips = []
+
+
 class DripBase(object):
     """
     A base object for defining a Drip.
@@ -114,6 +301,27 @@ class DripBase(object):
     body_template = None
     from_email = None
     from_email_name = None
+    #: messages sent over a single SMTP connection, falsy sends one by one
+    send_batch_size = getattr(settings, 'DRIP_SEND_BATCH_SIZE', None)
+    #: SentDrips buffered in memory before they are written at once
+    sent_drip_batch_size = getattr(settings, 'DRIP_SENT_DRIP_BATCH_SIZE', 100)
+    #: threads delivering rendered messages, falsy sends from this thread
+    send_workers = getattr(settings, 'DRIP_SEND_WORKERS', None)
+    #: rendered messages waiting for a free worker
+    send_queue_size = getattr(settings, 'DRIP_SEND_QUEUE_SIZE', 100)
+    #: users loaded per query while sending, falsy loads them all at once
+    queryset_page_size = getattr(settings, 'DRIP_QUERYSET_PAGE_SIZE', None)
+    #: load what the templates look up on `user` along with the users
+    plan_template_queries = True
+    #: render the message once for all users, for drips that are the
+    #: very same for everybody
+    broadcast = False
+    #: render templates once and only fill in `{{ user.<name> }}` per user
+    prerender_templates = getattr(settings, 'DRIP_PRERENDER_TEMPLATES', False)
+    #: 'django' or 'jinja2'
+    template_engine = 'django'
+    #: encode what every message has in common once, see SkeletonMessage
+    prebuild_messages = getattr(settings, 'DRIP_PREBUILD_MESSAGES', False)
 
     def __init__(self, drip_model, *args, **kwargs):
         self.drip_model = drip_model
@@ -123,6 +331,15 @@ class DripBase(object):
         self.from_email_name = kwargs.pop('from_email_name', self.from_email_name)
         self.subject_template = kwargs.pop('subject_template', self.subject_template)
         self.body_template = kwargs.pop('body_template', self.body_template)
+        self.send_batch_size = kwargs.pop('send_batch_size', self.send_batch_size)
+        self.sent_drip_batch_size = kwargs.pop('sent_drip_batch_size', self.sent_drip_batch_size)
+        self.send_workers = kwargs.pop('send_workers', self.send_workers)
+        self.send_queue_size = kwargs.pop('send_queue_size', self.send_queue_size)
+        self.queryset_page_size = kwargs.pop('queryset_page_size', self.queryset_page_size)
+        self.broadcast = kwargs.pop('broadcast', self.broadcast)
+        self.prerender_templates = kwargs.pop('prerender_templates', self.prerender_templates)
+        self.template_engine = kwargs.pop('template_engine', self.template_engine)
+        self.prebuild_messages = kwargs.pop('prebuild_messages', self.prebuild_messages)
 
         if not self.name:
             raise AttributeError('You must define a name.')
@@ -161,27 +378,10 @@ class DripBase(object):
 
     def apply_queryset_rules(self, qs):
         """
-        First collect all filter/exclude kwargs and apply any annotations.
-        Then apply all filters at once, and all excludes at once.
+        Apply the compiled rules of the drip model for our "now", see
+        `QuerySetRulePlan.apply`.
         """
-        clauses = {
-            'filter': [],
-            'exclude': []}
-
-        for rule in self.drip_model.queryset_rules.all():
-
-            clause = clauses.get(rule.method_type, clauses['filter'])
-
-            kwargs = rule.filter_kwargs(qs, now=self.now)
-            clause.append(Q(**kwargs))
-
-            qs = rule.apply_any_annotation(qs)
-
-        if clauses['exclude']:
-            qs = qs.exclude(functools.reduce(operator.or_, clauses['exclude']))
-        qs = qs.filter(*clauses['filter'])
-
-        return qs
+        return self.drip_model.get_queryset_rule_plan().apply(qs, now=self.now)
 
     ###################
     # ## MANAGEMENT ###
@@ -193,8 +393,60 @@ class DripBase(object):
         except AttributeError:
             self._queryset = self.apply_queryset_rules(self.queryset())\
                                  .distinct()
+            self._queryset = self.apply_template_lookups(self._queryset)
             return self._queryset
 
+    def get_template_variable_paths(self):
+        """
+        Returns the attribute paths the subject and body templates look
+        up on `user`, or None if they can not be known.
+        """
+        if self.template_engine != 'django':
+            return None
+        paths = set()
+        for source in (self.subject_template, self.body_template):
+            if not source:
+                continue
+            found = get_variable_paths(get_template(source))
+            if found is None:
+                return None
+            paths.update(found)
+        return paths
+
+    def apply_template_lookups(self, qs):
+        """
+        Adds the select_related, prefetch_related and only lookups that
+        load everything the templates use on `user` with the users
+        themselves, rather than with a query or more per user. Fields
+        are only left out for the default message class.
+        """
+        if not self.plan_template_queries:
+            return qs
+        paths = self.get_template_variable_paths()
+        if paths is None:
+            return qs
+
+        select_related, prefetch_related, only = get_related_lookups(qs.model, paths)
+        if select_related:
+            qs = qs.select_related(*select_related)
+        if prefetch_related:
+            qs = qs.prefetch_related(*prefetch_related)
+        # a custom message class may read any field, not just the ones
+        # the templates do
+        if only is not None and message_class_for(self.drip_model.message_class) is DripMessage:
+            # needed to send the message and to log failures
+            field_names = set(field.name for field in qs.model._meta.concrete_fields)
+            required = set(['email', getattr(qs.model, 'USERNAME_FIELD', 'username')])
+            qs = qs.only(*(only | (required & field_names)))
+        return qs
+
+    def iter_queryset(self):
+        """
+        Iterates the users of `get_queryset`, in pages of
+        `queryset_page_size` if set.
+        """
+        return iterate_queryset(self.get_queryset(), self.queryset_page_size)
+
     def run(self):
         """
         Get the queryset, prune sent people, and send it.
@@ -211,12 +463,35 @@ class DripBase(object):
         """
         Do an exclude for all Users who have a SentDrip already.
         """
-        target_user_ids = self.get_queryset().values_list('id', flat=True)
-        exclude_user_ids = SentDrip.objects.filter(date__lt=conditional_now(),
-                                                   drip=self.drip_model,
-                                                   user__id__in=target_user_ids)\
-                                           .values_list('user_id', flat=True)
-        self._queryset = self.get_queryset().exclude(id__in=exclude_user_ids)
+        self._queryset = self.exclude_sent(self.get_queryset())
+
+    def exclude_sent(self, qs):
+        """
+        Excludes users of `qs` who have a SentDrip for this drip.
+
+        This is a correlated NOT EXISTS on (drip_id, user_id) rather than
+        an IN over the whole audience, so it can use the composite index
+        on SentDrip no matter how many drips were sent before.
+        """
+        connection = connections[qs.db]
+        quote_name = connection.ops.quote_name
+
+        sent_drip_opts = SentDrip._meta
+        not_sent = (
+            'NOT EXISTS (SELECT 1 FROM {sent_drip} '
+            'WHERE {sent_drip}.{drip_id} = %s '
+            'AND {sent_drip}.{user_id} = {user}.{user_pk} '
+            'AND {sent_drip}.{date} < %s)'
+        ).format(
+            sent_drip=quote_name(sent_drip_opts.db_table),
+            drip_id=quote_name(sent_drip_opts.get_field('drip').column),
+            user_id=quote_name(sent_drip_opts.get_field('user').column),
+            date=quote_name(sent_drip_opts.get_field('date').column),
+            user=quote_name(qs.model._meta.db_table),
+            user_pk=quote_name(qs.model._meta.pk.column))
+        now = sent_drip_opts.get_field('date').get_db_prep_value(conditional_now(), connection)
+
+        return qs.extra(where=[not_sent], params=[self.drip_model.pk, now])
 
     def send(self):
         """
@@ -230,27 +505,204 @@ class DripBase(object):
         if not self.from_email:
             self.from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
         MessageClass = message_class_for(self.drip_model.message_class)
+        make_message = self.get_message_factory(MessageClass)
+
+        # a SentDrip is only buffered once its message went through, and
+        # whatever is buffered gets written even if sending blows up
+        sent_drips = SentDripBuffer(self.sent_drip_batch_size)
+        try:
+            if self.send_workers:
+                return self.send_concurrently(make_message, sent_drips)
+            if self.send_batch_size:
+                return self.send_batched(make_message, sent_drips)
+
+            count = 0
+            for user in self.iter_queryset():
+                message_instance = make_message(user)
+                try:
+                    result = message_instance.message.send()
+                    if result:
+                        sent_drips.add(self.build_sent_drip(user, message_instance))
+                        count += 1
+                except Exception as e:
+                    logging.error("Failed to send drip %s to user %s: %s" % (self.drip_model.id, user, e))
+
+            return count
+        finally:
+            sent_drips.flush()
+
+    def send_batched(self, make_message, sent_drips):
+        """
+        Like `send`, but every `send_batch_size` messages share one
+        connection instead of opening a new one per user.
+        """
+        count = 0
+        batch = []
+        for user in self.iter_queryset():
+            batch.append(make_message(user))
+            if len(batch) >= self.send_batch_size:
+                count += self.send_batch(batch, sent_drips)
+                batch = []
+        if batch:
+            count += self.send_batch(batch, sent_drips)
+        return count
+
+    def send_batch(self, message_instances, sent_drips):
+        """
+        Deliver `message_instances` over a single connection and buffer
+        a SentDrip for each message that went through.
 
+        Returns count of buffered SentDrips.
+        """
         count = 0
-        for user in self.get_queryset():
-            message_instance = MessageClass(self, user)
-            try:
-                result = message_instance.message.send()
-                if result:
-                    SentDrip.objects.create(
-                        drip=self.drip_model,
-                        user=user,
-                        from_email=self.from_email,
-                        from_email_name=self.from_email_name,
-                        subject=message_instance.subject,
-                        # body=message_instance.body
-                    )
+        connection = self.get_connection()
+        try:
+            connection.open()
+            for message_instance in message_instances:
+                if self.deliver(message_instance, connection):
+                    sent_drips.add(self.build_sent_drip(message_instance.user, message_instance))
                     count += 1
-            except Exception as e:
-                logging.error("Failed to send drip %s to user %s: %s" % (self.drip_model.id, user, e))
+        finally:
+            connection.close()
+        return count
 
+    def send_concurrently(self, make_message, sent_drips):
+        """
+        Like `send`, but messages are only rendered in this thread and
+        delivered by `send_workers` threads, each over its own connection.
+
+        At most `send_queue_size` rendered messages wait for a worker, and
+        SentDrips are still only buffered from this thread.
+        """
+        pending = queue.Queue(maxsize=self.send_queue_size)
+        delivered = queue.Queue()
+        errors = []
+
+        workers = []
+        for i in range(self.send_workers):
+            worker = threading.Thread(target=self.delivery_worker, args=(pending, delivered, errors))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        count = 0
+        try:
+            for user in self.iter_queryset():
+                if errors:
+                    break
+                message_instance = make_message(user)
+                # render before handing over, workers only talk to the server
+                try:
+                    message_instance.message
+                except Exception as e:
+                    logging.error("Failed to send drip %s to user %s: %s" % (self.drip_model.id, user, e))
+                    continue
+                pending.put(message_instance)
+                count += self.buffer_delivered(delivered, sent_drips)
+        finally:
+            for worker in workers:
+                pending.put(None)
+            for worker in workers:
+                worker.join()
+            count += self.buffer_delivered(delivered, sent_drips)
+
+        if errors:
+            raise errors[0]
         return count
 
+    def delivery_worker(self, pending, delivered, errors):
+        """
+        Delivers messages from `pending` until it gets a `None`, putting
+        every message that went through into `delivered`.
+
+        Should the worker itself fail, the error goes into `errors` and
+        the messages it still gets are dropped, so that putting them into
+        `pending` never blocks.
+        """
+        connection = None
+        try:
+            connection = self.get_connection()
+            try:
+                connection.open()
+            except Exception as e:
+                # the backend opens a connection per message instead
+                logging.error("Failed to open connection for drip %s: %s" % (self.drip_model.id, e))
+
+            while True:
+                message_instance = pending.get()
+                if message_instance is None:
+                    break
+                if self.deliver(message_instance, connection):
+                    delivered.put(message_instance)
+        except Exception as e:
+            errors.append(e)
+            while pending.get() is not None:
+                pass
+        finally:
+            if connection is not None:
+                connection.close()
+
+    def buffer_delivered(self, delivered, sent_drips):
+        """
+        Buffers a SentDrip for every message delivered so far.
+
+        Returns count of buffered SentDrips.
+        """
+        count = 0
+        while True:
+            try:
+                message_instance = delivered.get_nowait()
+            except queue.Empty:
+                return count
+            sent_drips.add(self.build_sent_drip(message_instance.user, message_instance))
+            count += 1
+
+    def deliver(self, message_instance, connection):
+        """
+        Send a single message over an open `connection`, reconnecting
+        once if the server dropped it in the meantime.
+
+        Returns whether the message was sent.
+        """
+        try:
+            # rendering fails for this user only
+            message = message_instance.message
+            if hasattr(message, 'connection'):
+                message.connection = connection
+            try:
+                return bool(message.send())
+            except smtplib.SMTPServerDisconnected:
+                connection.close()
+                connection.open()
+                return bool(message.send())
+        except Exception as e:
+            logging.error("Failed to send drip %s to user %s: %s" % (
+                self.drip_model.id, message_instance.user, e))
+        return False
+
+    def get_connection(self):
+        return get_connection()
+
+    def get_message_factory(self, MessageClass):
+        """
+        Returns a callable making the message instance for a user.
+        """
+        if self.broadcast:
+            return BroadcastMessage(self, MessageClass)
+        if self.prebuild_messages and MessageClass.message is DripMessage.message:
+            return SkeletonMessage(self, MessageClass)
+        return functools.partial(MessageClass, self)
+
+    def build_sent_drip(self, user, message_instance):
+        return SentDrip(
+            drip=self.drip_model,
+            user=user,
+            from_email=self.from_email,
+            from_email_name=self.from_email_name,
+            subject=message_instance.subject,
+            # body=message_instance.body
+        )
+
     #####################
     # ## USER DEFINED ###
     #####################
@@ -267,6 +719,122 @@ class DripBase(object):
         return User.objects
 
 
+#: VariablePlans by message class, variables, user model and annotations
+variable_plan_cache = LRUCache(64)
+
+
+class VariablePlan(object):
+    """
+    How a MailgunBatchMessage class gets the Mailgun variables of users,
+    worked out once rather than for every variable of every user.
+
+    A variable is the attribute of the user, called if callable, unless
+    that is falsy. Then it is taken from what `get_vars_<name>(users)`
+    of the message returns for a page of users, a mapping by user id,
+    and else from `get_var_<name>(user)`, whichever there is. Variables
+    that are plain columns or annotations of the users queryset and have
+    no such methods are read with `values_list`, and if all of them are,
+    users are not loaded as model instances at all.
+    """
+
+    def __init__(self, MessageClass, variables, qs):
+        opts = qs.model._meta
+        columns = {}
+        for field in opts.concrete_fields:
+            if not field.is_relation:
+                columns[field.name] = field.name
+            columns[field.attname] = field.attname
+        for name in qs.query.annotations:
+            columns[name] = name
+
+        self.variables = tuple(variables)
+        #: (name, get_var_ method name, get_vars_ method name) for every
+        #: variable, the methods None if there are none
+        self.accessors = []
+        #: what `values_list` reads for every variable, if it can
+        self.columns = []
+        for name in self.variables:
+            hook = 'get_var_' + name
+            hook = hook if hasattr(MessageClass, hook) else None
+            batch_hook = 'get_vars_' + name
+            batch_hook = batch_hook if hasattr(MessageClass, batch_hook) else None
+            self.accessors.append((name, hook, batch_hook))
+            if hook is None and batch_hook is None and name in columns:
+                self.columns.append(columns[name])
+        self.needs_instances = len(self.columns) != len(self.variables)
+
+    @classmethod
+    def for_message(cls, message, qs):
+        MessageClass = type(message)
+        variables = tuple(message.drip_base.variables)
+        key = (MessageClass, variables, qs.model, tuple(sorted(qs.query.annotations)))
+        return variable_plan_cache.get_or_set(key, lambda: cls(MessageClass, variables, qs))
+
+    def missing(self, name, strict):
+        if strict:
+            raise ValueError('There is no way to get `{0}` from user.'
+                             'user.{0} and MailgunBatchMessage.get_var_{0} tried'.format(name))
+        return ''
+
+    def batch_values(self, message, users):
+        """
+        Returns `{name: {user id: value}}` from the `get_vars_` methods,
+        each called once for those of `users` who need it.
+        """
+        values = {}
+        for name, hook, batch_hook in self.accessors:
+            if batch_hook is None:
+                continue
+            needed = [user for user in users if not getattr(user, name, None)]
+            values[name] = getattr(message, batch_hook)(needed) if needed else {}
+        return values
+
+    def variables_for_user(self, message, user, strict=True, batch_values=None):
+        if batch_values is None:
+            batch_values = self.batch_values(message, [user])
+        variables = {}
+        for name, hook, batch_hook in self.accessors:
+            value = getattr(user, name, None)
+            if value:
+                if callable(value):
+                    value = value()
+            elif batch_hook is not None and user.pk in batch_values[name]:
+                value = batch_values[name][user.pk]
+            elif hook is not None:
+                value = getattr(message, hook)(user)
+            else:
+                value = self.missing(name, strict)
+            variables[name] = value
+        return variables
+
+    def recipients(self, message, qs, page_size=None, strict=True):
+        """
+        Yields `(pk, email, variables)` for every user of `qs` with an
+        email address, loading them `page_size` at a time if given.
+        """
+        if self.needs_instances:
+            pages = queryset_pages(qs, page_size) if page_size else [qs]
+            for users in pages:
+                users = [user for user in users if user.email]
+                batch_values = self.batch_values(message, users)
+                for user in users:
+                    yield user.pk, user.email, self.variables_for_user(message, user, strict, batch_values)
+            return
+
+        names = self.variables
+        rows = qs.values_list('pk', 'email', *self.columns)
+        for row in iterate_queryset(rows, page_size, get_pk=operator.itemgetter(0)):
+            if not row[1]:
+                continue
+            values = row[2:]
+            variables = dict(zip(names, values))
+            if not all(values):
+                for name, value in variables.items():
+                    if not value:
+                        variables[name] = self.missing(name, strict)
+            yield row[0], row[1], variables
+
+
 class MailgunBatchMessage(DripMessage):
 
     def __init__(self, drip_base):
@@ -292,41 +860,40 @@ class MailgunBatchMessage(DripMessage):
             self._context = Context(ctx)
         return self._context
 
+    def get_variable_plan(self, qs=None):
+        if qs is None:
+            qs = self.drip_base.queryset()
+        return VariablePlan.for_message(self, qs.all())
+
     def mailgun_variables_for_user(self, user, strict=True):
         """ Generates dict of type {'some_var': 42} for `user`.
         Mailgun will substitute these variables in place of %recipient.some_var%
         """
-
-        def get_value(v):
-            """ Get value of `v` variable for user given."""
-            # try to get attribute from user
-            obj = getattr(user, v, None)
-            # if no, search for corresponding method in MailgunBatchMessage
-            if not obj:
-                obj = getattr(self, 'get_var_' + v, None)
-                if obj:
-                    obj = functools.partial(obj, user)
-
-                # is there is no function to get var value raise or return empty string
-                else:
-                    if strict:
-                        raise ValueError('There is no way to get `{0}` from user.'
-                                         'user.{0} and MailgunBatchMessage.get_var_{0} tried'.format(v))
-                    return ''
-
-            return obj() if callable(obj) else obj
-
-        vars = {v: get_value(v) for v in self.drip_base.variables}
-        return vars
+        return self.get_variable_plan().variables_for_user(self, user, strict)
 
     def get_variables(self, qs=None, strict=True):
         """ Generates dict of type {<email>: <template variables>} for
         queryset of recipients"""
-        qs = qs or self.drip_base.get_queryset()
-        recipient_variables_dict = {u.email: self.mailgun_variables_for_user(u, strict)
-                                    for u in qs if u.email}
+        if qs is None:
+            qs = self.drip_base.get_queryset()
+        recipients = self.iter_recipient_variables(qs, strict)
+        return dict((email, variables) for _, email, variables in recipients)
+
+    def get_variables_for_users(self, users, strict=True):
+        """ Like `get_variables`, for an iterable of users """
+        plan = self.get_variable_plan()
+        users = [u for u in users if u.email]
+        batch_values = plan.batch_values(self, users)
+        recipient_variables_dict = {u.email: plan.variables_for_user(self, u, strict, batch_values)
+                                    for u in users}
         return recipient_variables_dict
 
+    def iter_recipient_variables(self, qs, strict=True):
+        """ Yields (<pk>, <email>, <template variables>) for every user of
+        queryset with an email address, a page at a time"""
+        plan = self.get_variable_plan(qs)
+        return plan.recipients(self, qs, self.drip_base.queryset_page_size, strict)
+
 
 class MailgunBatchMessageWithBaseTemplate(MailgunBatchMessage):
 
@@ -335,18 +902,18 @@ class MailgunBatchMessageWithBaseTemplate(MailgunBatchMessage):
         super(MailgunBatchMessageWithBaseTemplate, self).__init__(*args, **kwargs)
 
     @property
-    def body(self):
-        if not self._body:
-            body_template = (
-                '{{% extends "{0}" %}}  '.format(self.base_template_html_path) +
-                self.drip_base.body_template
-            )
-            self._body = Template(body_template).render(self.context)
-        return self._body
+    def body_source(self):
+        return (
+            '{{% extends "{0}" %}}  '.format(self.base_template_html_path) +
+            self.drip_base.body_template
+        )
 
 
 class DripMailgun(DripBase):
     variables = settings.MAILGUN.get('TEMPLATE_VARIABLES', ())
+    # templates only see the Mailgun variables, not the user itself
+    plan_template_queries = False
+    prerender_templates = False
 
     MAILGUN_SECRET_API_KEY = settings.MAILGUN['SECRET_API_KEY']
     MAILGUN_DOMAIN = settings.MAILGUN['DOMAIN']
@@ -357,12 +924,28 @@ class DripMailgun(DripBase):
         settings.MAILGUN.get('SEND_MESSAGE_ENDPOINT_TEMPLATE', 'https://api.mailgun.net/v3/{0}/messages')
     MAILGUN_YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY =\
         settings.MAILGUN.get('YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY', False)
+    MAILGUN_CONCURRENCY =\
+        settings.MAILGUN.get('CONCURRENCY', 1)
+    MAILGUN_RATE_LIMIT =\
+        settings.MAILGUN.get('RATE_LIMIT', None)
+    MAILGUN_MAX_RETRIES =\
+        settings.MAILGUN.get('MAX_RETRIES', 3)
+    MAILGUN_RETRY_BACKOFF =\
+        settings.MAILGUN.get('RETRY_BACKOFF', 1.0)
+    MAILGUN_USE_STORED_TEMPLATES =\
+        settings.MAILGUN.get('USE_STORED_TEMPLATES', False)
+    MAILGUN_TEMPLATES_ENDPOINT_TEMPLATE =\
+        settings.MAILGUN.get('TEMPLATES_ENDPOINT_TEMPLATE', 'https://api.mailgun.net/v3/{0}/templates')
 
     def __init__(self, *args, **kwargs):
         self.tags_list = kwargs.pop('tags_list', [])
         self.template_base = kwargs.pop('template_base')
         self.base_template_html_path = kwargs.pop('base_template_html_path')
         self.drip_instance = kwargs.pop('drip_instance')
+        # post, get and delete instead of the shared session, see mailgun.Client
+        self.post = kwargs.pop('post', None)
+        self.get = kwargs.pop('get', None)
+        self.delete = kwargs.pop('delete', None)
         super(DripMailgun, self).__init__(*args, **kwargs)
 
         self.MAILGUN_VARIABLE_GENERATION_FUNCTION =\
@@ -380,38 +963,185 @@ class DripMailgun(DripBase):
                              .format(zip(*self.drip_model.TEMPLATE_BASE_CHOICES)[0]))
         return m
 
+    def get_client(self):
+        return mailgun.Client(
+            post=self.post,
+            get=self.get,
+            delete=self.delete,
+            rate=self.MAILGUN_RATE_LIMIT,
+            retries=self.MAILGUN_MAX_RETRIES,
+            backoff=self.MAILGUN_RETRY_BACKOFF)
+
     def send(self):
+        """
+        Send the message in batches of `MAILGUN_BATCHSIZE` users.
+
+        Batches that failed on earlier runs, as Mailgun throttled them or
+        failed to handle them, are posted again first. Then users are
+        loaded a page at a time and each batch is posted as soon as it is
+        full, so only one batch is held in memory. Users who joined after
+        sending started are left for the next run, as are users of batches
+        still not accepted. Batches Mailgun rejected for good, and those
+        an earlier send broke off in the middle of, are never posted
+        again unless told to, see MailgunBatch.
+
+        Every batch is kept as a MailgunBatch, and SentDrips are created
+        only for the users of batches Mailgun accepted. Users with invalid
+        email addresses are skipped and listed in `invalid_emails`.
+
+        Returns count of created SentDrips.
+        """
         if not self.from_email:
             self.from_email = getattr(settings, 'DRIP_FROM_EMAIL', settings.DEFAULT_FROM_EMAIL)
         m = self.get_message()
 
-        qs = self.get_queryset()
-
-        mailgun.send_batch(
+        # if email sending is serious, we dont want to raise errors
+        # if variable not found
+        strict = not self.MAILGUN_YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY
+
+        # addresses of users left out for being invalid
+        self.invalid_emails = []
+
+        # a batch still pending was on its way when an earlier send broke
+        # off, so Mailgun may or may not have sent it
+        self.drip_model.mailgun_batches.filter(status='pending').update(status='unknown')
+
+        # users of batches not accepted wait for these, but only failed
+        # batches are posted again by themselves
+        outstanding = []
+        outstanding_user_ids = set()
+        for batch in self.drip_model.mailgun_batches.exclude(status='accepted').order_by('pk'):
+            outstanding_user_ids.update(batch.get_user_ids())
+            if batch.status == 'failed':
+                outstanding.append(batch)
+
+        # user ids and MailgunBatch of every batch on its way, by the id
+        # of its variables
+        pending = {}
+
+        def recipient_batches():
+            for batch in outstanding:
+                recipient_variables_dict = batch.get_recipient_variables()
+                pending[id(recipient_variables_dict)] = (batch.get_user_ids(), batch)
+                yield recipient_variables_dict
+
+            recipients = (recipient for recipient in self.iter_recipients(m, strict)
+                          if recipient[0] not in outstanding_user_ids)
+            for recipients in mailgun.batches(self.valid_recipients(recipients), self.MAILGUN_BATCHSIZE):
+                recipient_variables_dict = dict((email, variables) for _, email, variables in recipients)
+                user_ids = [pk for pk, _, _ in recipients]
+                batch = MailgunBatch.objects.create(
+                    drip=self.drip_model,
+                    user_ids=json.dumps(user_ids),
+                    recipient_variables=json.dumps(recipient_variables_dict, separators=(',', ':')))
+                pending[id(recipient_variables_dict)] = (user_ids, batch)
+                yield recipient_variables_dict
+
+        client = self.get_client()
+        template_name, template_version = None, None
+        if self.MAILGUN_USE_STORED_TEMPLATES:
+            template_name, template_version = self.upload_template(m, client)
+
+        batch_responses = mailgun.send_batches(
+            recipient_batches(),
+            concurrency=self.MAILGUN_CONCURRENCY,
+            validate_emails=None,
             subject=m.subject,
             template_html=m.body,
             template_plain=m.plain,
-
-            # if email sending is serious, we dont want to raise errors
-            # if variable not found
-            recipient_variables_dict=m.get_variables(
-                qs=qs,
-                strict=not self.MAILGUN_YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY),
-
             from_email=m.from_,
             tags_list=self.tags_list,
             mailgun_api_key=self.MAILGUN_SECRET_API_KEY,
             mailgun_domain=self.MAILGUN_DOMAIN,
-            mailgun_batchsize=self.MAILGUN_BATCHSIZE,
+            post=client.post,
             url_template=self.MAILGUN_SEND_MESSAGE_ENDPOINT_TEMPLATE,
             YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY=self.MAILGUN_YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY,
+            template_name=template_name,
+            template_version=template_version,
         )
 
-        def create_sent_drip(user):
-            return SentDrip(drip=self.drip_model,
-                            user=user,
-                            from_email=self.from_email,
-                            from_email_name=self.from_email_name,
-                            subject=m.subject)
-        sent_drips = [create_sent_drip(user=user) for user in qs]
-        SentDrip.objects.bulk_create(sent_drips)
+        count = 0
+        for recipient_variables_dict, response in batch_responses:
+            user_ids, batch = pending.pop(id(recipient_variables_dict))
+            if mailgun.is_accepted(response):
+                batch.status = 'accepted'
+            elif mailgun.is_retriable(response):
+                batch.status = 'failed'
+            else:
+                batch.status = 'rejected'
+            batch.status_code = getattr(response, 'status_code', None)
+            batch.response = getattr(response, 'text', '')
+            if batch.status != 'accepted':
+                batch.save()
+                logging.error("Mailgun did not accept batch %s of drip %s: %s" % (
+                    batch.pk, self.drip_model.id, batch.response))
+                continue
+
+            # an accepted batch without its SentDrips would never be sent
+            # again, nor would its users be left out of later sends
+            with transaction.atomic():
+                SentDrip.objects.bulk_create([
+                    SentDrip(drip=self.drip_model,
+                             user_id=user_id,
+                             from_email=self.from_email,
+                             from_email_name=self.from_email_name,
+                             subject=m.subject)
+                    for user_id in user_ids], batch_size=self.sent_drip_batch_size)
+                batch.save()
+            count += len(user_ids)
+
+        return count
+
+    def upload_template(self, m, client):
+        """
+        Stores the html of `m` as a version of the Mailgun template of
+        the drip, so it is uploaded once per revision of the drip rather
+        than with every batch. Returns the template name and version, or
+        Nones when there is no html to store.
+        """
+        if not m.body:
+            return None, None
+        name = 'drip-%s' % self.drip_model.pk
+        version = mailgun.upload_template(
+            name,
+            m.body,
+            mailgun_api_key=self.MAILGUN_SECRET_API_KEY,
+            mailgun_domain=self.MAILGUN_DOMAIN,
+            url_template=self.MAILGUN_TEMPLATES_ENDPOINT_TEMPLATE,
+            description=self.drip_model.name,
+            post=client.post,
+            get=client.get,
+            delete=client.delete)
+        return name, version
+
+    def valid_recipients(self, recipients):
+        """
+        Yields the `(pk, email, variables)` of `recipients` with a valid
+        email address. Addresses are validated a batch at a time, each
+        only once and remembered, and those not valid are logged and
+        added to `invalid_emails` rather than failing the send.
+        """
+        for chunk in mailgun.batches(recipients, self.MAILGUN_BATCHSIZE):
+            _, invalid = EmailValidation.partition([email for _, email, _ in chunk])
+            if invalid:
+                self.invalid_emails.extend(invalid)
+                logging.warning("Drip %s skips invalid email addresses: %s" % (
+                    self.drip_model.id, ', '.join(invalid)))
+                invalid = set(invalid)
+            for recipient in chunk:
+                if recipient[1] not in invalid:
+                    yield recipient
+
+    def iter_recipients(self, m, strict=True):
+        """
+        Yields `(pk, email, variables)` for the users with an email
+        address of `get_queryset`, in pages keyset paginated on the
+        primary key. Only users who were there when iterating started
+        are included.
+        """
+        last_pk = self.queryset().order_by('-pk').values_list('pk', flat=True).first()
+        if last_pk is None:
+            return iter(())
+        qs = self.get_queryset().filter(pk__lte=last_pk).exclude(email='')
+        plan = m.get_variable_plan(qs)
+        return plan.recipients(m, qs, self.queryset_page_size or self.MAILGUN_BATCHSIZE, strict)
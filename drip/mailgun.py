@@ -1,9 +1,37 @@
+import hashlib
+import itertools
 import json
+import logging
+import threading
+import time
 from pprint import pprint
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator, EmailValidator
+from django.utils.six.moves import queue
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size=10):
+    """
+    Returns the requests Session shared by every batch, which keeps
+    connections to Mailgun alive between posts. Its pool holds up to
+    `pool_size` connections, as given the first time it is asked for.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+            session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+            _session = session
+    return _session
 
 
 def chunks(xs, size):
@@ -11,8 +39,26 @@ def chunks(xs, size):
         yield xs[i:i+size]
 
 
+email_validator = EmailValidator()
+
+
 def validate_email(email):
-    EmailValidator()(email)
+    email_validator(email)
+
+
+def partition_emails(emails):
+    """
+    Returns lists of the valid and of the invalid addresses of `emails`.
+    """
+    valid, invalid = [], []
+    for email in emails:
+        try:
+            email_validator(email)
+        except ValidationError:
+            invalid.append(email)
+        else:
+            valid.append(email)
+    return valid, invalid
 
 
 def validate_url(url):
@@ -23,6 +69,369 @@ def mock_post(*args, **kwargs):
     return (args, kwargs)
 
 
+class TokenBucket(object):
+    """
+    Lets through `rate` calls to `acquire` per second on average, and
+    bursts of up to `capacity` calls, making callers wait otherwise.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, self.rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting for it if there is none left. Returns the
+        seconds waited.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a token is taken even if it is still to come, so waiting
+            # callers line up rather than race for the next one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class Client(object):
+    """
+    Posts to Mailgun no faster than `rate` requests per second, if
+    given, and retries requests Mailgun throttled (429) or failed to
+    handle (5xx) up to `retries` times. Retries wait for `backoff`
+    seconds, doubled every time, or as long as Mailgun asks to.
+
+    `post`, `get` and `delete` are what actually post, get and delete,
+    the shared session by default.
+    """
+
+    def __init__(self, post=None, rate=None, burst=None, retries=3, backoff=1.0, sleep=time.sleep, get=None,
+                 delete=None):
+        self._post = post
+        self._get = get
+        self._delete = delete
+        self.bucket = TokenBucket(rate, burst, sleep=sleep) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def should_retry(self, response):
+        return is_retriable(response)
+
+    def get_delay(self, response, attempt):
+        delay = self.backoff * 2 ** attempt
+        try:
+            return max(delay, float(response.headers.get('Retry-After')))
+        except (AttributeError, TypeError, ValueError):
+            return delay
+
+    def request(self, send, url, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            response = send(url, **kwargs)
+            if attempt >= self.retries or not self.should_retry(response):
+                return response
+            self.sleep(self.get_delay(response, attempt))
+            attempt += 1
+
+    def post(self, url, **kwargs):
+        return self.request(self._post or get_session().post, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request(self._get or get_session().get, url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request(self._delete or get_session().delete, url, **kwargs)
+
+
+def is_accepted(response):
+    """
+    Whether Mailgun accepted the batch `response` is for. Anything but a
+    requests Response, such as what `mock_post` returns, counts as such.
+    """
+    return getattr(response, 'ok', True)
+
+
+def is_retriable(response):
+    """
+    Whether the batch `response` is for may go through when posted again,
+    as Mailgun throttled it (429) or failed to handle it (5xx). Any other
+    refusal is final.
+    """
+    status_code = getattr(response, 'status_code', None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+def batches(iterable, size):
+    """
+    Yields lists of `size` items of `iterable`, the last one possibly
+    shorter, taking no more items from it than the next list needs.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def validate_recipient_variables(recipient_variables_dict):
+    if not isinstance(recipient_variables_dict, dict):
+        raise TypeError('Should be dict as described in https://documentation.mailgun.com/user_manual.html#batch-sending')  # NOQA
+    for email, variables in recipient_variables_dict.items():
+        if isinstance(variables, dict):
+            continue
+        raise TypeError('Should be dict as described in https://documentation.mailgun.com/user_manual.html#batch-sending')  # NOQA
+
+
+def drop_invalid_emails(recipient_variables_dict, validate_emails=partition_emails):
+    """
+    Removes the recipients with invalid addresses from
+    `recipient_variables_dict`, checking all of them in one go with
+    `validate_emails`, and returns the invalid addresses.
+    """
+    _, invalid = validate_emails(list(recipient_variables_dict))
+    for email in invalid:
+        del recipient_variables_dict[email]
+    if invalid:
+        logging.warning('Dropped %d invalid email addresses: %s' % (len(invalid), ', '.join(invalid)))
+    return invalid
+
+
+def get_template_version(template_html):
+    """
+    Returns the version tag to store `template_html` under on Mailgun,
+    which changes along with the html.
+    """
+    return hashlib.sha1(template_html.encode('utf-8')).hexdigest()[:12]
+
+
+def upload_template(
+        name,
+        template_html,
+        mailgun_api_key,
+        mailgun_domain,
+        url_template,
+        description='',
+        post=None,
+        get=None,
+        delete=None):
+    """
+    Stores `template_html` as a version of the Mailgun template `name`,
+    unless there is one for that html already, see
+    `get_template_version`. A new version becomes the active one, and
+    the one it replaces is deleted, so a template never holds more than
+    the few versions still in use.
+
+    Returns the version tag of `template_html`.
+    """
+    validate_url(url_template)
+    if post is None:
+        post = get_session().post
+    if get is None:
+        get = get_session().get
+    if delete is None:
+        delete = get_session().delete
+
+    version = get_template_version(template_html)
+    url = '%s/%s' % (url_template.format(mailgun_domain), name)
+    auth = ('api', mailgun_api_key)
+    if get('%s/versions/%s' % (url, version), auth=auth).status_code == 200:
+        return version
+
+    response = get(url, auth=auth, params={'active': 'yes'})
+    if response.status_code == 200:
+        try:
+            previous = response.json()['template']['version']['tag']
+        except (ValueError, KeyError, TypeError):
+            previous = None
+        response = post('%s/versions' % url, auth=auth, data={
+            'tag': version,
+            'template': template_html,
+            'active': 'yes',
+        })
+    else:
+        previous = None
+        response = post(url_template.format(mailgun_domain), auth=auth, data={
+            'name': name,
+            'description': description,
+            'template': template_html,
+            'tag': version,
+        })
+    if not is_accepted(response):
+        raise requests.HTTPError('Mailgun did not store template %s: %s' % (name, response.text),
+                                 response=response)
+
+    if previous is not None and previous != version:
+        response = delete('%s/versions/%s' % (url, previous), auth=auth)
+        if not is_accepted(response):
+            logging.warning('Mailgun did not delete version %s of template %s: %s' % (
+                previous, name, getattr(response, 'text', '')))
+    return version
+
+
+def post_batch(
+        recipient_variables_dict,
+        subject,
+        template_html,
+        template_plain,
+        from_email,
+        tags_list,
+        mailgun_api_key,
+        mailgun_domain,
+        post=None,
+        url_template=None,
+        YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY=False,
+        template_name=None,
+        template_version=None):
+    """
+    Posts a single batch of recipients to Mailgun and returns the response.
+
+    With a `template_name`, the batch refers to that stored template,
+    see `upload_template`, rather than carrying the html and text, and
+    Mailgun makes up the text from the html. A `template_version` picks
+    the version to use, the active one otherwise.
+    """
+    if post is None:
+        post = get_session().post
+
+    data = {
+        'subject': subject,
+        'from': from_email,
+        'to': list(recipient_variables_dict),
+        'recipient-variables': json.dumps(recipient_variables_dict, separators=(',', ':')),
+        'o:testmode': True,
+    }
+    if template_name:
+        data['template'] = template_name
+        data['t:text'] = 'yes'
+        if template_version:
+            data['t:version'] = template_version
+    else:
+        if template_html:
+            data['html'] = template_html
+        if template_plain:
+            data['text'] = template_plain
+    if tags_list:
+        data['o:tag'] = tags_list
+    if YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY:
+        data['o:testmode'] = False
+
+    return post(url_template.format(mailgun_domain), auth=('api', mailgun_api_key), data=data)
+
+
+def send_batches(recipient_batches, concurrency=1, validate_emails=partition_emails, **kwargs):
+    """
+    Validates and posts every `{<email>: <template variables>}` dict of
+    `recipient_batches` as soon as it comes in, yielding each dict along
+    with its response. Takes the arguments of `post_batch` otherwise.
+
+    Invalid addresses are dropped from each dict before it is posted,
+    see `drop_invalid_emails`. Pass `validate_emails=None` if they were
+    validated already. A dict left empty is not posted, and yielded
+    with a response of None.
+
+    Up to `concurrency` batches are posted at once. Responses are still
+    yielded in the order of `recipient_batches`, and only a few batches
+    more than that are held at a time, so `recipient_batches` can be a
+    generator building batches as they are needed.
+    """
+    validate_url(kwargs.get('url_template'))
+    if concurrency <= 1:
+        for recipient_variables_dict in recipient_batches:
+            validate_recipient_variables(recipient_variables_dict)
+            if validate_emails is not None:
+                drop_invalid_emails(recipient_variables_dict, validate_emails)
+            if not recipient_variables_dict:
+                yield recipient_variables_dict, None
+                continue
+            yield recipient_variables_dict, post_batch(recipient_variables_dict, **kwargs)
+        return
+
+    get_session(pool_size=concurrency)
+    pending = queue.Queue(maxsize=concurrency)
+    done = queue.Queue()
+
+    def worker():
+        while True:
+            task = pending.get()
+            if task is None:
+                return
+            index, recipient_variables_dict = task
+            try:
+                done.put((index, recipient_variables_dict, post_batch(recipient_variables_dict, **kwargs), None))
+            except Exception as e:
+                done.put((index, recipient_variables_dict, None, e))
+
+    workers = []
+    for i in range(concurrency):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+    # posted batches by their index, until their turn to be yielded comes
+    finished = {}
+    next_index = 0
+    submitted = 0
+    try:
+        for recipient_variables_dict in recipient_batches:
+            validate_recipient_variables(recipient_variables_dict)
+            if validate_emails is not None:
+                drop_invalid_emails(recipient_variables_dict, validate_emails)
+            if not recipient_variables_dict:
+                # nothing to post, done as soon as its turn comes
+                finished[submitted] = (recipient_variables_dict, None, None)
+            else:
+                pending.put((submitted, recipient_variables_dict))
+            submitted += 1
+
+            # yield what is done, waiting once too many batches are held
+            while True:
+                while next_index in finished:
+                    batch, response, error = finished.pop(next_index)
+                    next_index += 1
+                    if error is not None:
+                        raise error
+                    yield batch, response
+                if next_index == submitted or (done.empty() and submitted - next_index < 2 * concurrency):
+                    break
+                index, batch, response, error = done.get()
+                finished[index] = (batch, response, error)
+
+        while next_index < submitted:
+            while next_index in finished:
+                batch, response, error = finished.pop(next_index)
+                next_index += 1
+                if error is not None:
+                    raise error
+                yield batch, response
+            if next_index < submitted:
+                index, batch, response, error = done.get()
+                finished[index] = (batch, response, error)
+    finally:
+        # drop what was not posted yet, e.g. when the caller stops early
+        while True:
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                break
+        for thread in workers:
+            pending.put(None)
+        for thread in workers:
+            thread.join()
+
+
 def send_batch(
         # VVV mail data VVV
         subject,
@@ -36,49 +445,37 @@ def send_batch(
         mailgun_api_key,
         mailgun_domain,
         mailgun_batchsize,
-        post=requests.post,
+        post=None,
         url_template=None,
-        YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY=False):
+        YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY=False,
+        concurrency=1,
+        validate_emails=partition_emails,
+        template_name=None,
+        template_version=None):
 
     # validations
-    if not isinstance(recipient_variables_dict, dict):
-        raise TypeError('Should be dict as described in https://documentation.mailgun.com/user_manual.html#batch-sending')  # NOQA
-    for email, variables in recipient_variables_dict.items():
-        validate_email(email)
-        if isinstance(variables, dict):
-            continue
-        raise TypeError('Should be dict as described in https://documentation.mailgun.com/user_manual.html#batch-sending')  # NOQA
+    validate_recipient_variables(recipient_variables_dict)
     validate_url(url_template)
 
-    # common params
-    url = url_template.format(mailgun_domain)
-    auth = ('api', mailgun_api_key)
-
-    responses = []
-
     # chunking and sending
-    for chunk in chunks(recipient_variables_dict.items(), mailgun_batchsize):
-        recipient_list = zip(*chunk)[0]
-        recipient_variables = dict(chunk)
-
-        data = {
-            'subject': subject,
-            'from': from_email,
-            'to': recipient_list,
-            'recipient-variables': json.dumps(recipient_variables, separators=(',', ':')),
-            'o:testmode': True,
-        }
-        if template_html:
-            data['html'] = template_html
-        if template_plain:
-            data['text'] = template_plain
-        if tags_list:
-            data['o:tag'] = tags_list
-        if YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY:
-            data['o:testmode'] = False
-
-        r = post(url, auth=auth, data=data)
-        responses.append(r)
+    recipient_batches = (dict(chunk) for chunk in batches(recipient_variables_dict.items(), mailgun_batchsize))
+    responses = [response for _, response in send_batches(
+        recipient_batches,
+        concurrency=concurrency,
+        validate_emails=validate_emails,
+        subject=subject,
+        template_html=template_html,
+        template_plain=template_plain,
+        from_email=from_email,
+        tags_list=tags_list,
+        mailgun_api_key=mailgun_api_key,
+        mailgun_domain=mailgun_domain,
+        post=post,
+        url_template=url_template,
+        YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY=YES_I_WANT_TO_SEND_MAILGUN_EMAIL_SERIOUSLY,
+        template_name=template_name,
+        template_version=template_version,
+    )]
     if post is mock_post:
         pprint(responses)
     return responses
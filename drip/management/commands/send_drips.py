@@ -2,6 +2,19 @@ from django.core.management.base import BaseCommand
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--smtp', action='store_true', dest='smtp', default=False,
+            help='Send using the configured email backend instead of the Mailgun API.')
+        parser.add_argument(
+            '--workers', type=int, dest='send_workers',
+            help='Number of threads delivering messages (--smtp only).')
+        parser.add_argument(
+            '--queue-size', type=int, dest='send_queue_size',
+            help='Rendered messages waiting for a free worker (--smtp only).')
+
     def handle(self, *args, **options):
         from drip.models import Drip
-        Drip.objects.filter(enabled=True).send()
+        drip_kwargs = dict((key, options[key]) for key in ('send_workers', 'send_queue_size')
+                           if options.get(key))
+        Drip.objects.filter(enabled=True).send(use_mailgun=not options['smtp'], **drip_kwargs)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drip', '0006_auto_20160518_1609'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='sentdrip',
+            index_together=set([('drip', 'user')]),
+        ),
+    ]
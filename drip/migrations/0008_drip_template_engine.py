@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drip', '0007_sentdrip_drip_user_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='drip',
+            name='template_engine',
+            field=models.CharField(default=b'django', help_text=b'Jinja2 templates use the same context, but need Jinja2 installed and a Jinja2 base template.', max_length=20, choices=[(b'django', b'Django'), (b'jinja2', b'Jinja2')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drip', '0008_drip_template_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailgunBatch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('lastchanged', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(default=b'pending', max_length=12, choices=[(b'pending', b'Pending'), (b'accepted', b'Accepted'), (b'failed', b'Failed')])),
+                ('user_ids', models.TextField()),
+                ('recipient_variables', models.TextField()),
+                ('status_code', models.PositiveIntegerField(null=True, blank=True)),
+                ('response', models.TextField(blank=True)),
+                ('drip', models.ForeignKey(related_name='mailgun_batches', to='drip.Drip')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='mailgunbatch',
+            index_together=set([('drip', 'status')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drip', '0009_mailgunbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailValidation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('email', models.CharField(unique=True, max_length=254)),
+                ('is_valid', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('drip', '0010_emailvalidation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mailgunbatch',
+            name='status',
+            field=models.CharField(default=b'pending', max_length=12, choices=[(b'pending', b'Pending'), (b'accepted', b'Accepted'), (b'failed', b'Failed'), (b'rejected', b'Rejected'), (b'unknown', b'Unknown')]),
+        ),
+    ]
@@ -0,0 +1,234 @@
+import re
+import uuid
+from email.header import Header
+from email.utils import formatdate
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import forbid_multi_line_headers, make_msgid, DNS_NAME
+
+
+# how the email generators split text into lines
+newline_re = re.compile(r'\r\n|\r|\n')
+
+
+def fold_header(name, value, linesep):
+    """
+    Folds the header value `value` the way the email generators do.
+    """
+    try:
+        return Header(value, header_name=name).encode(linesep=linesep, maxlinelen=78)
+    except TypeError:
+        # Python 2 always folds with '\n'
+        return linesep.join(Header(value, header_name=name).encode().split('\n'))
+
+
+def is_ascii(text):
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+class MessageSkeleton(object):
+    """
+    An email message serialized once, with slots for the headers and
+    the text parts that differ between recipients.
+
+    `parts` are the content types of the text parts to leave out. They
+    have to be utf-8 and sent as they are (7bit or 8bit), as encoded
+    parts could not be filled in without encoding them again.
+    """
+
+    def __init__(self, email_message, headers=('To', 'Message-ID', 'Date'), parts=()):
+        self.email_message = email_message
+        self.encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        self.msg = email_message.message()
+
+        # every slot is marked by a token that can be split on later
+        self.slots = {}
+        for name in headers:
+            token = self.make_token()
+            if name in self.msg:
+                # keeps the header where it is
+                self.msg.replace_header(name, token)
+            else:
+                self.msg[name] = token
+            self.slots[token] = name
+
+        #: the transfer encoding of every slotted part by content type
+        self.parts = {}
+        for part in self.msg.walk():
+            content_type = part.get_content_type()
+            if part.is_multipart() or content_type not in parts:
+                continue
+            if content_type in self.parts:
+                raise ValueError('More than one %s part' % content_type)
+            encoding = part['Content-Transfer-Encoding']
+            if part.get_content_charset() != 'utf-8' or encoding not in ('7bit', '8bit'):
+                raise ValueError('The %s part is %s encoded' % (content_type, encoding))
+            token = self.make_token()
+            part.set_payload(token)
+            self.slots[token] = content_type
+            self.parts[content_type] = encoding
+        if len(self.parts) != len(parts):
+            raise ValueError('Some of %s are not parts of the message' % ', '.join(parts))
+
+        pattern = '(%s)' % '|'.join(re.escape(token) for token in self.slots)
+        self.token_re = re.compile(pattern)
+        self.token_bytes_re = re.compile(pattern.encode('ascii'))
+        self._serialized = {}
+
+    @staticmethod
+    def make_token():
+        return 'drip-slot-%s' % uuid.uuid4().hex
+
+    def serialized(self, as_bytes, linesep):
+        """
+        Returns the message serialized as bytes or text, split into a
+        list of static parts with slot names in between.
+        """
+        key = (as_bytes, linesep)
+        try:
+            return self._serialized[key]
+        except KeyError:
+            pass
+
+        if as_bytes:
+            pieces = self.token_bytes_re.split(self.msg.as_bytes(linesep=linesep))
+            tokens = dict((token.encode('ascii'), name) for token, name in self.slots.items())
+        else:
+            pieces = self.token_re.split(self.msg.as_string(linesep=linesep))
+            tokens = self.slots
+        # split keeps the tokens at every odd index
+        parts = [tokens[piece] if i % 2 else piece for i, piece in enumerate(pieces)]
+        self._serialized[key] = parts
+        return parts
+
+    def accepts(self, parts):
+        """
+        Whether `parts`, text by content type, fit the slotted parts,
+        which holds if they are the same parts and only those sent as
+        8bit are not plain ascii.
+        """
+        if set(parts) != set(self.parts):
+            return False
+        for content_type, text in parts.items():
+            if is_ascii(text) != (self.parts[content_type] == '7bit'):
+                return False
+        return True
+
+    def render(self, headers, parts=None, fallback=None):
+        """
+        Returns a PreparedMessage of this skeleton with `headers` and
+        `parts` filled in, see `accepts` for the latter.
+
+        `fallback` returns the message built the usual way, for when it
+        is serialized in a way the parts can not be filled into.
+        """
+        encoded = {}
+        for name, value in headers.items():
+            encoded[name] = forbid_multi_line_headers(name, value, self.encoding)[1]
+        return PreparedMessage(self, encoded, parts or {}, fallback)
+
+
+class PreparedMessage(object):
+    """
+    What `EmailMessage.message()` returns, as far as the email backends
+    are concerned, for a MessageSkeleton with its slots filled in.
+    """
+
+    def __init__(self, skeleton, headers, parts=None, fallback=None):
+        self.skeleton = skeleton
+        self.headers = headers
+        self.parts = parts or {}
+        self.fallback = fallback
+
+    def __getitem__(self, name):
+        for slot_name, value in self.headers.items():
+            if slot_name.lower() == name.lower():
+                return value
+        return self.skeleton.msg[name]
+
+    def get(self, name, failobj=None):
+        value = self[name]
+        return failobj if value is None else value
+
+    def get_charset(self):
+        return self.skeleton.msg.get_charset()
+
+    def join(self, as_bytes, linesep):
+        if not as_bytes and not all(is_ascii(text) for text in self.parts.values()):
+            # 8bit text is encoded again when serialized as a string
+            return self.fallback().as_string(linesep=linesep)
+
+        parts = self.skeleton.serialized(as_bytes, linesep)
+        pieces = []
+        for i, part in enumerate(parts):
+            if i % 2:
+                if part in self.parts:
+                    part = linesep.join(newline_re.split(self.parts[part]))
+                    if as_bytes:
+                        part = part.encode('utf-8')
+                else:
+                    part = fold_header(part, self.headers[part], linesep)
+                    if as_bytes:
+                        part = part.encode('ascii')
+            pieces.append(part)
+        return (b'' if as_bytes else '').join(pieces)
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        return self.join(True, linesep)
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.join(False, linesep)
+
+    def __str__(self):
+        return self.as_string()
+
+
+class PreparedEmailMessage(EmailMultiAlternatives):
+    """
+    A copy of `email_message` sent to `to`, built from `skeleton`
+    instead of encoding the whole message again.
+
+    `subject`, `body` and `alternatives` replace those of `email_message`
+    and have to fit the slots of the skeleton, or the message is built
+    the usual way.
+    """
+
+    def __init__(self, skeleton, email_message, to, subject=None, body=None, alternatives=None):
+        self.__dict__.update(email_message.__dict__)
+        self.skeleton = skeleton
+        self.to = list(to)
+        self.connection = None
+        if subject is not None:
+            self.subject = subject
+        if body is not None:
+            self.body = body
+        if alternatives is not None:
+            self.alternatives = list(alternatives)
+
+    def message(self):
+        headers = {
+            'To': ', '.join(self.to),
+            'Message-ID': make_msgid(domain=DNS_NAME),
+            'Date': formatdate(),
+        }
+        # as EmailMessage.message() would, keep a date given explicitly
+        for name, value in self.extra_headers.items():
+            if name.lower() == 'date':
+                headers['Date'] = value
+        if 'Subject' in self.skeleton.slots.values():
+            headers['Subject'] = self.subject
+
+        parts = {}
+        if self.skeleton.parts:
+            parts['text/plain'] = self.body
+            for content, mimetype in self.alternatives:
+                parts[mimetype] = content
+            if not self.skeleton.accepts(parts):
+                return EmailMultiAlternatives.message(self)
+
+        return self.skeleton.render(headers, parts, fallback=lambda: EmailMultiAlternatives.message(self))
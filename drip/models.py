@@ -1,11 +1,17 @@
+import json
+import operator
+import functools
 from datetime import datetime
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
 from django.core.exceptions import ValidationError
+from django.core.validators import EmailValidator
 from django.conf import settings
+from django.utils import timezone
 from django.utils.functional import cached_property
 
-from drip.utils import get_user_model
+from drip.utils import get_user_model, LRUCache, basestring
 from drip.querysets import DripQueryset
 
 # just using this to parse, but totally insane package naming...
@@ -13,6 +19,67 @@ from drip.querysets import DripQueryset
 import timedelta as djangotimedelta
 
 
+#: compiled QuerySetRulePlans by drip id, as (Drip.lastchanged, plan)
+rule_plan_cache = LRUCache(getattr(settings, 'DRIP_RULE_PLAN_CACHE_SIZE', 256))
+#: parsed QuerySetRule.field_values by their raw string
+field_value_cache = LRUCache(getattr(settings, 'DRIP_FIELD_VALUE_CACHE_SIZE', 1024))
+
+
+class RelativeTime(object):
+    """
+    A `now-7 days` or `today+3 days` rule value, resolved against
+    "now" every time the rule is applied.
+    """
+
+    def __init__(self, base, delta):
+        self.base = base
+        self.delta = delta
+
+    def __repr__(self):
+        return '<RelativeTime: %s %s>' % (self.base, self.delta)
+
+    def resolve(self, now=datetime.now):
+        value = now()
+        if self.base == 'today':
+            value = value.date()
+        return value + self.delta
+
+
+def parse_field_value(field_value):
+    """
+    Parses a QuerySetRule.field_value once into what it stands for:
+
+    "now-60 days" -> RelativeTime('now', -timedelta(days=60))
+    "F_date_joined" -> F('date_joined')
+    "True" -> True
+    "42" -> "42"
+    """
+    if not isinstance(field_value, basestring):
+        return field_value
+
+    def parse():
+        # set time deltas and dates
+        for base in ('now', 'today'):
+            if field_value.startswith(base + '-'):
+                return RelativeTime(base, -djangotimedelta.parse(field_value[len(base) + 1:]))
+            if field_value.startswith(base + '+'):
+                return RelativeTime(base, djangotimedelta.parse(field_value[len(base) + 1:]))
+
+        # F expressions
+        if field_value.startswith('F_'):
+            return models.F(field_value[len('F_'):])
+
+        # set booleans
+        if field_value == 'True':
+            return True
+        if field_value == 'False':
+            return False
+
+        return field_value
+
+    return field_value_cache.get_or_set(field_value, parse)
+
+
 class DripSplitSubject(models.Model):
     drip = models.ForeignKey('Drip', related_name='split_test_subjects')
     subject = models.CharField(max_length=150)
@@ -39,6 +106,10 @@ class Drip(models.Model):
         ('with_base', 'Insert content of body field into default email base template'),
         ('standalone', 'Use content of body as standalone template'),
     )
+    TEMPLATE_ENGINE_CHOICES = (
+        ('django', 'Django'),
+        ('jinja2', 'Jinja2'),
+    )
 
     date = models.DateTimeField(auto_now_add=True)
     lastchanged = models.DateTimeField(auto_now=True)
@@ -88,6 +159,12 @@ class Drip(models.Model):
         blank=True,
         default='default',
     )
+    template_engine = models.CharField(
+        max_length=20,
+        choices=TEMPLATE_ENGINE_CHOICES,
+        default='django',
+        help_text='Jinja2 templates use the same context, but need Jinja2 installed and a Jinja2 base template.',
+    )
 
     blog_entries = models.ManyToManyField(
         'blog_entries.BlogEntry',
@@ -104,13 +181,17 @@ class Drip(models.Model):
             from_email_name=self.from_email_name if self.from_email_name else None,
             subject_template=self.subject_template if self.subject_template else None,
             body_template=self.body_html_template if self.body_html_template else None,
+            template_engine=self.template_engine,
             **kwargs)
         return drip
 
     @property
     def drip(self):
+        return self.get_drip()
+
+    def get_drip(self, **kwargs):
         from drip.drips import DripBase
-        return self.init_drip(klass=DripBase)
+        return self.init_drip(klass=DripBase, **kwargs)
 
     @property
     def drip_mailgun(self):
@@ -123,6 +204,22 @@ class Drip(models.Model):
             drip_instance=self,
         )
 
+    def get_queryset_rule_plan(self):
+        """
+        Returns the QuerySetRulePlan of this drip, compiled once until
+        the drip or any of its rules change.
+        """
+        if self.pk is None:
+            return QuerySetRulePlan(self.queryset_rules.all())
+
+        cached = rule_plan_cache.get(self.pk)
+        if cached is not None and cached[0] == self.lastchanged:
+            return cached[1]
+
+        plan = QuerySetRulePlan(self.queryset_rules.all())
+        rule_plan_cache.set(self.pk, (self.lastchanged, plan))
+        return plan
+
     def get_blog_entries_for_newsletter(self, count=5):
         return self.blog_entries.all()
 
@@ -175,6 +272,125 @@ class SentDrip(models.Model):
         default=None,
     )
 
+    class Meta:
+        index_together = [
+            ('drip', 'user'),
+        ]
+
+
+class MailgunBatch(models.Model):
+    """
+    Keeps a record of every batch of a drip posted to Mailgun, so that
+    batches which did not go through can be posted again later.
+
+    Only failed batches, which Mailgun throttled or failed to handle, are
+    posted again by themselves. Rejected batches, and those left pending
+    by a send that broke off (unknown, Mailgun may have them), wait for
+    `retry` or `mark_accepted`, and their users for them.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('accepted', 'Accepted'),
+        ('failed', 'Failed'),
+        ('rejected', 'Rejected'),
+        ('unknown', 'Unknown'),
+    )
+
+    date = models.DateTimeField(auto_now_add=True)
+    lastchanged = models.DateTimeField(auto_now=True)
+
+    drip = models.ForeignKey('drip.Drip', related_name='mailgun_batches')
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='pending')
+
+    # JSON encoded ids of the users in the batch and their variables
+    user_ids = models.TextField()
+    recipient_variables = models.TextField()
+
+    status_code = models.PositiveIntegerField(null=True, blank=True)
+    response = models.TextField(blank=True)
+
+    class Meta:
+        index_together = [
+            ('drip', 'status'),
+        ]
+
+    def get_user_ids(self):
+        return json.loads(self.user_ids)
+
+    def get_recipient_variables(self):
+        return json.loads(self.recipient_variables)
+
+    def retry(self):
+        """
+        Has the batch posted again on the next send.
+        """
+        self.status = 'failed'
+        self.save()
+
+    def mark_accepted(self):
+        """
+        Records the batch as accepted, along with a SentDrip for each of
+        its users, for a batch Mailgun turns out to have sent.
+        """
+        with transaction.atomic():
+            SentDrip.objects.bulk_create([
+                SentDrip(drip=self.drip,
+                         user_id=user_id,
+                         subject=self.drip.subject_template or '',
+                         from_email=self.drip.from_email or None,
+                         from_email_name=self.drip.from_email_name or None)
+                for user_id in self.get_user_ids()])
+            self.status = 'accepted'
+            self.save()
+
+
+class EmailValidation(models.Model):
+    """
+    Remembers whether an email address is valid, so each address is
+    checked once no matter how many drips it gets.
+    """
+    date = models.DateTimeField(auto_now_add=True)
+
+    email = models.CharField(max_length=254, unique=True)
+    is_valid = models.BooleanField(default=False)
+
+    @classmethod
+    def partition(cls, emails):
+        """
+        Returns lists of the valid and of the invalid addresses of
+        `emails`, validating only those not seen before, and remembering
+        them for next time.
+        """
+        emails = list(emails)
+        known = dict(cls.objects.filter(email__in=emails).values_list('email', 'is_valid'))
+
+        validator = EmailValidator()
+        new = {}
+        for email in emails:
+            if email in known or email in new:
+                continue
+            try:
+                validator(email)
+            except ValidationError:
+                new[email] = False
+            else:
+                new[email] = True
+
+        storable = [cls(email=email, is_valid=is_valid) for email, is_valid in new.items()
+                    if len(email) <= cls._meta.get_field('email').max_length]
+        if storable:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(storable)
+            except IntegrityError:
+                # validated by another run in the meantime
+                pass
+
+        known.update(new)
+        valid = [email for email in emails if known[email]]
+        invalid = [email for email in emails if not known[email]]
+        return valid, invalid
+
 
 METHOD_TYPES = (
     ('filter', 'Filter'),
@@ -231,45 +447,42 @@ class QuerySetRule(models.Model):
 
         return field_name
 
-    def apply_any_annotation(self, qs):
+    @property
+    def annotation(self):
+        """
+        Returns `{annotated_field_name: Count(...)}` for `__count` field
+        names, else an empty dict.
+        """
         if self.field_name.endswith('__count'):
-            field_name = self.annotated_field_name
             agg, _, _ = self.field_name.rpartition('__')
-            qs = qs.annotate(**{field_name: models.Count(agg, distinct=True)})
+            return {self.annotated_field_name: models.Count(agg, distinct=True)}
+        return {}
+
+    def apply_any_annotation(self, qs):
+        annotation = self.annotation
+        if annotation:
+            qs = qs.annotate(**annotation)
         return qs
 
-    def filter_kwargs(self, qs, now=datetime.now):
+    @property
+    def lookup(self):
         # Support Count() as m2m__count
-        field_name = self.annotated_field_name
-        field_name = '__'.join([field_name, self.lookup_type])
-        field_value = self.field_value
+        return '__'.join([self.annotated_field_name, self.lookup_type])
 
-        # set time deltas and dates
-        if self.field_value.startswith('now-'):
-            field_value = self.field_value.replace('now-', '')
-            field_value = now() - djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('now+'):
-            field_value = self.field_value.replace('now+', '')
-            field_value = now() + djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('today-'):
-            field_value = self.field_value.replace('today-', '')
-            field_value = now().date() - djangotimedelta.parse(field_value)
-        elif self.field_value.startswith('today+'):
-            field_value = self.field_value.replace('today+', '')
-            field_value = now().date() + djangotimedelta.parse(field_value)
-
-        # F expressions
-        if self.field_value.startswith('F_'):
-            field_value = self.field_value.replace('F_', '')
-            field_value = models.F(field_value)
+    @property
+    def parsed_field_value(self):
+        """
+        `field_value` as a RelativeTime, an F expression, a boolean or
+        the literal string, see `parse_field_value`.
+        """
+        return parse_field_value(self.field_value)
 
-        # set booleans
-        if self.field_value == 'True':
-            field_value = True
-        if self.field_value == 'False':
-            field_value = False
+    def filter_kwargs(self, qs, now=datetime.now):
+        field_value = self.parsed_field_value
+        if isinstance(field_value, RelativeTime):
+            field_value = field_value.resolve(now)
 
-        kwargs = {field_name: field_value}
+        kwargs = {self.lookup: field_value}
 
         return kwargs
 
@@ -285,3 +498,58 @@ class QuerySetRule(models.Model):
 
         # catch as default
         return qs.filter(**kwargs)
+
+
+class QuerySetRulePlan(object):
+    """
+    The queryset rules of a drip, fetched once and kept in memory so
+    they can be applied for any "now" without touching the rule table.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.annotations = [annotation for annotation in (rule.annotation for rule in self.rules)
+                            if annotation]
+        # (method_type, lookup, parsed value), only RelativeTimes
+        # are left to bind on every apply
+        self.clauses = [(rule.method_type, rule.lookup, rule.parsed_field_value)
+                        for rule in self.rules]
+
+    def apply(self, qs, now=datetime.now):
+        """
+        First collect all filter/exclude kwargs and apply any annotations.
+        Then apply all filters at once, and all excludes at once.
+        """
+        clauses = {
+            'filter': [],
+            'exclude': []}
+
+        for method_type, lookup, value in self.clauses:
+            clause = clauses.get(method_type, clauses['filter'])
+            if isinstance(value, RelativeTime):
+                value = value.resolve(now)
+            clause.append(Q(**{lookup: value}))
+
+        return self.apply_clauses(qs, clauses['filter'], clauses['exclude'])
+
+    def apply_clauses(self, qs, filters, excludes):
+        """
+        Annotate `qs`, then exclude anything matching any of `excludes`
+        and keep what matches all of `filters`.
+        """
+        for annotation in self.annotations:
+            qs = qs.annotate(**annotation)
+
+        if excludes:
+            qs = qs.exclude(functools.reduce(operator.or_, excludes))
+        qs = qs.filter(*filters)
+
+        return qs
+
+
+def forget_rule_plan(sender, instance, **kwargs):
+    rule_plan_cache.discard(instance.drip_id)
+    # other processes only notice the drip changing
+    Drip.objects.filter(pk=instance.drip_id).update(lastchanged=timezone.now())
+models.signals.post_save.connect(forget_rule_plan, sender=QuerySetRule)
+models.signals.post_delete.connect(forget_rule_plan, sender=QuerySetRule)
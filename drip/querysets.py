@@ -3,7 +3,7 @@ from django.db.models.query import QuerySet
 
 class DripQueryset(QuerySet):
 
-    def send(self, use_mailgun=True):
+    def send(self, use_mailgun=True, **drip_kwargs):
         for drip in self:
-            drip_ = drip.drip_mailgun if use_mailgun else drip.drip
+            drip_ = drip.drip_mailgun if use_mailgun else drip.get_drip(**drip_kwargs)
             drip_.run()
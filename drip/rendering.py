@@ -0,0 +1,368 @@
+import re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Template, Context, TemplateDoesNotExist, VariableDoesNotExist
+from django.template.base import (
+    FilterExpression, Node, NodeList, TagHelperNode, TextNode, Variable, VariableNode, render_value_in_context)
+from django.template.engine import Engine
+from django.template.defaulttags import (
+    AutoEscapeControlNode, DebugNode, ForNode, IfEqualNode, IfNode, SsiNode, WithNode)
+from django.template.loader_tags import BlockNode, ExtendsNode, IncludeNode
+from django.template.smartif import TokenBase
+from django.utils.html import strip_tags
+
+from drip.utils import LRUCache
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+
+#: compiled templates shared by every drip in the process
+template_cache = LRUCache(getattr(settings, 'DRIP_TEMPLATE_CACHE_SIZE', 256))
+
+
+def get_template(source, engine='django'):
+    """
+    Returns a compiled template for `source`, parsing it only the first
+    time it is seen. `engine` is 'django' or 'jinja2'.
+
+    The source itself is the cache key, so editing a drip simply misses
+    the cache and the stale entry is evicted in time.
+    """
+    if engine == 'jinja2':
+        return template_cache.get_or_set(('jinja2', source), lambda: JinjaTemplate(source))
+    if engine != 'django':
+        raise ValueError('Unknown template engine %r' % engine)
+    return template_cache.get_or_set(source, lambda: Template(source))
+
+
+def load_template_source(name):
+    """
+    Returns the source of the template `name` as found by the loaders of
+    the default Django template engine, or None.
+    """
+    for loader in Engine.get_default().template_loaders:
+        # the cached loader only wraps the others
+        for loader in getattr(loader, 'loaders', [loader]):
+            try:
+                return loader.load_template_source(name)[0]
+            except TemplateDoesNotExist:
+                continue
+    return None
+
+
+_jinja_environment = None
+
+
+def get_jinja_environment():
+    """
+    Returns the Jinja2 Environment drips are rendered with, which finds
+    templates to extend or include with the Django template loaders.
+    """
+    global _jinja_environment
+    if _jinja_environment is None:
+        if jinja2 is None:
+            raise ImproperlyConfigured('Jinja2 needs to be installed to render drips with it.')
+        _jinja_environment = jinja2.Environment(
+            autoescape=True,
+            loader=jinja2.FunctionLoader(load_template_source))
+    return _jinja_environment
+
+
+class JinjaTemplate(object):
+    """
+    A compiled Jinja2 template, rendering a Context the way a Django
+    Template does.
+    """
+
+    def __init__(self, source):
+        self.template = get_jinja_environment().from_string(source)
+
+    def render(self, context):
+        return self.template.render(context.flatten())
+
+
+# modules of the built in nodes, which only look at the variables they
+# were given, bar the ones below
+BUILTIN_NODE_MODULES = ('django.template.base', 'django.template.defaulttags', 'django.template.loader_tags')
+
+
+def _template_variables(obj, seen):
+    """
+    Yields every Variable found anywhere below `obj`, be it a node, its
+    filter expressions and their arguments, `{% if %}` conditions and so
+    on. Raises ValueError for nodes rendering other templates, and for
+    nodes of custom tags, which may look at the whole context.
+    """
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+
+    if isinstance(obj, (ExtendsNode, IncludeNode, SsiNode)):
+        raise ValueError('%s renders a template of its own' % type(obj).__name__)
+    if isinstance(obj, Node) and (isinstance(obj, (TagHelperNode, DebugNode)) or
+                                  type(obj).__module__ not in BUILTIN_NODE_MODULES):
+        raise ValueError('%s may look at the whole context' % type(obj).__name__)
+
+    if isinstance(obj, Variable):
+        yield obj
+    elif isinstance(obj, (list, tuple, NodeList)):
+        for item in obj:
+            for variable in _template_variables(item, seen):
+                yield variable
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            for variable in _template_variables(item, seen):
+                yield variable
+    elif isinstance(obj, (Node, FilterExpression, TokenBase)):
+        for item in vars(obj).values():
+            for variable in _template_variables(item, seen):
+                yield variable
+
+
+def get_variable_paths(template, root='user'):
+    """
+    Returns the set of attribute paths looked up on `root` anywhere in
+    `template`, e.g. ('profile', 'credits') for `{{ user.profile.credits }}`
+    and () for a bare `{{ user }}`.
+
+    Returns None if that can not be known, as the template extends or
+    includes others, or uses custom tags.
+    """
+    paths = set()
+    try:
+        for variable in _template_variables(template.nodelist, set()):
+            if variable.lookups and variable.lookups[0] == root:
+                paths.add(tuple(variable.lookups[1:]))
+    except ValueError:
+        return None
+    return paths
+
+
+# what HTMLParser, and so strip_tags, takes for the start of markup
+markup_start_re = re.compile(r'<(?=[a-zA-Z/!?])')
+# the end of a tag, or the start of a quoted attribute value in which a
+# '>' does not end the tag
+tag_end_re = re.compile(r'''=\s*(["'])|>''')
+
+
+def strip_markup(text, state=None):
+    """
+    Strips tags and comments from `text` the way `strip_tags` does,
+    starting within a tag or comment if `state` is 'tag' or 'comment',
+    or within a quoted attribute value if it is 'tag"' or "tag'".
+
+    Returns the stripped text and the state it ends in, so markup can
+    be followed across template nodes.
+    """
+    out = []
+    position = 0
+    while position < len(text):
+        if state is None:
+            match = markup_start_re.search(text, position)
+            if match is None:
+                out.append(text[position:])
+                break
+            out.append(text[position:match.start()])
+            state = 'comment' if text.startswith('<!--', match.start()) else 'tag'
+            position = match.end()
+        elif state == 'comment':
+            end = text.find('-->', position)
+            if end == -1:
+                break
+            position = end + 3
+            state = None
+        elif state == 'tag':
+            match = tag_end_re.search(text, position)
+            if match is None:
+                break
+            position = match.end()
+            state = 'tag' + match.group(1) if match.group(1) else None
+        else:
+            end = text.find(state[-1], position)
+            if end == -1:
+                break
+            position = end + 1
+            state = 'tag'
+    return ''.join(out), state
+
+
+# nodes rendering nothing but (some of) their child nodelists
+CONTAINER_NODES = (AutoEscapeControlNode, BlockNode, ForNode, IfEqualNode, WithNode)
+
+
+class PlainTextNode(Node):
+    """
+    Renders `node` with any markup in its output stripped.
+    """
+    child_nodelists = ()
+
+    def __init__(self, node):
+        self.node = node
+
+    def render(self, context):
+        output = self.node.render(context)
+        if '<' in output:
+            output = strip_tags(output)
+        return output
+
+
+def _make_plain(nodelist, state):
+    """
+    Turns `nodelist` into its plain text version in place: static text is
+    stripped once and now, any other output when rendered.
+
+    Returns the markup state `nodelist` ends in and whether its static
+    text contained any markup.
+    """
+    found_markup = False
+    for i, node in enumerate(nodelist):
+        if isinstance(node, ExtendsNode):
+            raise ValueError('Can not follow markup into a parent template')
+
+        if isinstance(node, TextNode):
+            stripped, state_after = strip_markup(node.s, state)
+            # a '<' the next node may turn into a tag, or markup left
+            # over that strip_tags would strip again
+            if stripped.endswith('<') or markup_start_re.search(stripped):
+                raise ValueError('Markup may be left after stripping once')
+            found_markup = found_markup or state_after is not None or len(stripped) != len(node.s)
+            node.s, state = stripped, state_after
+            continue
+
+        if isinstance(node, IfNode):
+            children = [child for _, child in node.conditions_nodelists]
+        elif isinstance(node, CONTAINER_NODES):
+            children = [getattr(node, attr) for attr in node.child_nodelists
+                        if isinstance(getattr(node, attr, None), NodeList)]
+        else:
+            children = None
+
+        if children is not None:
+            for child in children:
+                state_after, child_markup = _make_plain(child, state)
+                # a branch that opens or closes a tag can not be followed
+                if state_after != state:
+                    raise ValueError('Markup is opened or closed conditionally')
+                found_markup = found_markup or child_markup
+        elif state is None:
+            nodelist[i] = PlainTextNode(node)
+        else:
+            # inside a tag or comment, e.g. an attribute value
+            nodelist[i] = TextNode('')
+
+    return state, found_markup
+
+
+def get_plain_template(source):
+    """
+    Returns `(plain_template, has_markup)` for a body template.
+
+    `plain_template` renders what `strip_tags` would leave of the body,
+    with the static text stripped once up front. It is None if markup
+    can not be followed through the template, in which case the rendered
+    body has to be stripped instead. `has_markup` tells whether the static
+    text of the template contains any markup.
+    """
+    def make():
+        template = Template(source)
+        try:
+            state, has_markup = _make_plain(template.nodelist, None)
+        except ValueError:
+            return None, False
+        return template, has_markup or state is not None
+
+    return template_cache.get_or_set(('plain', source), make)
+
+
+# stands in for `{{ user.<name> }}` while rendering a TemplateSkeleton,
+# coming out as `&lt;name&gt;` where autoescaping is on
+slot_re = re.compile(r'\x00(<|&lt;)([^\x00<>&]+)(?:>|&gt;)\x00')
+
+
+class TemplateSkeleton(object):
+    """
+    A template rendered once, with a slot for every `{{ user.<name> }}`
+    in it. Rendering it for a user only renders the slot values.
+    """
+
+    def __init__(self, parts, slots, string_if_invalid=''):
+        #: static text, with a slot between every two parts
+        self.parts = parts
+        #: (name, Variable, autoescape) for every slot
+        self.slots = slots
+        self.string_if_invalid = string_if_invalid
+
+    def render(self, context):
+        """
+        Renders the skeleton for the user in `context`, to what the
+        template itself would render.
+        """
+        autoescape = context.autoescape
+        pieces = [self.parts[0]]
+        try:
+            for (name, variable, slot_autoescape), part in zip(self.slots, self.parts[1:]):
+                try:
+                    value = variable.resolve(context)
+                except VariableDoesNotExist:
+                    if '%s' in self.string_if_invalid:
+                        value = self.string_if_invalid % variable.var
+                    else:
+                        value = self.string_if_invalid
+                context.autoescape = slot_autoescape
+                pieces.append(render_value_in_context(value, context))
+                pieces.append(part)
+        finally:
+            context.autoescape = autoescape
+        return ''.join(pieces)
+
+
+def _make_skeleton(source):
+    template = get_template(source)
+
+    # `{{ user.<name> }}` without filters is all a slot can stand for
+    slot_variables = set()
+    for node in template.nodelist.get_nodes_by_type(VariableNode):
+        expression = node.filter_expression
+        variable = expression.var
+        if (isinstance(variable, Variable) and not expression.filters and
+                variable.lookups is not None and len(variable.lookups) == 2 and
+                variable.lookups[0] == 'user'):
+            slot_variables.add(id(variable))
+
+    names = set()
+    try:
+        for variable in _template_variables(template.nodelist, set()):
+            if variable.lookups and variable.lookups[0] == 'user':
+                if id(variable) not in slot_variables:
+                    # used by a tag or filtered, so rendered differently per user
+                    return None
+                names.add(variable.lookups[1])
+    except ValueError:
+        return None
+
+    markers = dict((name, '\x00<%s>\x00' % name) for name in names)
+    rendered = template.render(Context({'user': markers}))
+
+    pieces = slot_re.split(rendered)
+    parts = pieces[::3]
+    if any('\x00' in part for part in parts):
+        # some marker was changed on the way, e.g. by {% filter %}
+        return None
+    slots = []
+    for opening, name in zip(pieces[1::3], pieces[2::3]):
+        slots.append((name, Variable('user.%s' % name), opening != '<'))
+    return TemplateSkeleton(parts, slots, template.engine.string_if_invalid)
+
+
+def get_template_skeleton(source):
+    """
+    Returns a TemplateSkeleton for `source`, or None if it can not have
+    one: the template has to use `user` in `{{ user.<name> }}` only,
+    never in tags or through filters, and can not extend or include
+    other templates.
+    """
+    return template_cache.get_or_set(('skeleton', source), lambda: _make_skeleton(source))
@@ -1,3 +1,12 @@
+import functools
+import json
+import os
+import re
+import smtplib
+import threading
+import time
+import timeit
+import unittest
 from datetime import datetime, timedelta
 
 from django.test import TestCase
@@ -5,12 +14,17 @@ from django.test.client import RequestFactory
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve, reverse
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
 from django.conf import settings
+from django.template import Context, Node, Template
 from django.utils import timezone
+from django.utils.six.moves import BaseHTTPServer
+from django.utils.six.moves.urllib.parse import parse_qs
 
-from drip.models import Drip, SentDrip, QuerySetRule
-from drip.drips import DripBase, DripMessage
+from drip.models import Drip, SentDrip, QuerySetRule, EmailValidation
+from drip.drips import DripBase, DripMessage, DripMailgun, MailgunBatchMessage
 from drip.utils import get_user_model, unicode
+from drip.rendering import get_template, template_cache, jinja2
 
 from credits.models import Profile
 
@@ -35,6 +49,25 @@ class RulesTestCase(TestCase):
         rule = QuerySetRule(drip=self.drip, field_name='date_joined', lookup_type='lte', field_value='now-2 months')
         self.assertRaises(ValidationError, rule.clean)
 
+    def test_parse_field_value(self):
+        from django.db.models import F
+        from drip.models import parse_field_value, RelativeTime
+
+        relative = parse_field_value('now-60 days')
+        self.assertIsInstance(relative, RelativeTime)
+        now = timezone.now()
+        self.assertEqual(now - timedelta(days=60), relative.resolve(lambda: now))
+        self.assertEqual(now.date() + timedelta(days=3), parse_field_value('today+3 days').resolve(lambda: now))
+
+        self.assertIsInstance(parse_field_value('F_date_joined'), F)
+        self.assertIs(True, parse_field_value('True'))
+        self.assertIs(False, parse_field_value('False'))
+        self.assertEqual('42', parse_field_value('42'))
+
+    def test_field_value_parsed_once(self):
+        from drip.models import parse_field_value
+        self.assertIs(parse_field_value('now-60 days'), parse_field_value('now-60 days'))
+
 
 class DripsTestCase(TestCase):
 
@@ -113,6 +146,52 @@ class DripsTestCase(TestCase):
 
         simple_fields = get_simple_fields(self.User)
         self.assertTrue(bool([sf for sf in simple_fields if 'profile' in sf[0]]))
+    def test_queryset_pages(self):
+        from drip.utils import queryset_pages
+
+        pages = list(queryset_pages(self.User.objects.all(), 6))
+        self.assertEqual([6, 6, 6, 2], [len(page) for page in pages])
+
+        ids = [user.id for page in pages for user in page]
+        self.assertEqual(sorted(ids), ids)
+        self.assertEqual(list(self.User.objects.order_by('pk').values_list('pk', flat=True)), ids)
+
+    def test_queryset_pages_exact_multiple(self):
+        from drip.utils import queryset_pages
+
+        with self.assertNumQueries(2):
+            pages = list(queryset_pages(self.User.objects.all(), 10))
+        self.assertEqual([10, 10], [len(page) for page in pages])
+
+    def test_field_index_is_memoized(self):
+        from drip.utils import get_field_index, give_model_field
+
+        self.assertIs(get_field_index(self.User), get_field_index(self.User))
+
+        with self.assertNumQueries(0):
+            full_key, name, Model, ModelField = give_model_field('profile__credits', self.User)
+        self.assertEqual(('profile__credits', 'credits', Profile), (full_key, name, Model))
+        self.assertRaises(Exception, give_model_field, 'profile__nope', self.User)
+
+    def test_field_paths_endpoint(self):
+        import json
+
+        admin = self.User.objects.create(username='admin', email='admin@example.com',
+                                         is_staff=True, is_superuser=True)
+        url = reverse('admin:drip_field_paths')
+
+        def get(**params):
+            request = RequestFactory().get(url, params)
+            request.user = admin
+            match = resolve(url)
+            return json.loads(unicode(match.func(request, *match.args, **match.kwargs).content.decode('utf-8')))
+
+        top_level = get()
+        self.assertIn(['profile', 'OneToOneRel', True], top_level)
+        self.assertFalse([path for path in top_level if '__' in path[0]])
+
+        self.assertIn(['profile__credits', 'PositiveIntegerField', False], get(parent='profile'))
+        self.assertTrue(all(path[0].startswith('date_') for path in get(q='date_')))
 
     ##################
     ### TEST DRIPS ###
@@ -169,6 +248,25 @@ class DripsTestCase(TestCase):
         drip.prune()
         self.assertEqual(0, drip.get_queryset().count()) # everyone is pruned
 
+    def test_custom_drip_streamed(self):
+        model_drip = self.build_joined_date_drip(shift_one=0, shift_two=30)
+        drip = model_drip.init_drip(DripBase, queryset_page_size=3)
+
+        self.assertEqual(20, drip.send())
+        self.assertEqual(20, SentDrip.objects.filter(drip=model_drip).count())
+        self.assertEqual(20, len(set(SentDrip.objects.values_list('user_id', flat=True))))
+
+    def test_prune_only_for_same_drip(self):
+        model_drip = self.build_joined_date_drip()
+        other_drip = Drip.objects.create(name='Another Drip', subject_template='HI', body_html_template='HI')
+        users = list(model_drip.drip.get_queryset())
+        SentDrip.objects.create(drip=other_drip, user=users[0], subject='HI')
+        SentDrip.objects.create(drip=model_drip, user=users[1], subject='HELLO')
+
+        drip = model_drip.drip
+        drip.prune()
+        self.assertEqual([users[0].pk], list(drip.get_queryset().values_list('pk', flat=True)))
+
     def test_custom_short_term_drip(self):
         model_drip = self.build_joined_date_drip(shift_one=3, shift_two=4)
         drip = model_drip.drip
@@ -208,6 +306,48 @@ class DripsTestCase(TestCase):
         for count, shifted_drip in zip([0, 1, 1, 1, 1], drip.walk(into_past=3, into_future=2)):
             self.assertEqual(count, shifted_drip.get_queryset().count())
 
+    def test_rule_plan_is_cached(self):
+        model_drip = self.build_joined_date_drip()
+        drip = model_drip.drip
+        drip.apply_queryset_rules(drip.queryset())
+
+        with self.assertNumQueries(0):
+            for shifted_drip in drip.walk(into_past=3, into_future=2):
+                shifted_drip.apply_queryset_rules(shifted_drip.queryset())
+
+    def test_rule_plan_follows_rule_changes(self):
+        model_drip = self.build_joined_date_drip()
+        self.assertEqual(2, model_drip.drip.get_queryset().count())
+
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='profile__credits',
+            lookup_type='gte',
+            field_value='5'
+        )
+        self.assertEqual(1, model_drip.drip.get_queryset().count())
+
+        model_drip.queryset_rules.filter(field_name='profile__credits').delete()
+        self.assertEqual(2, model_drip.drip.get_queryset().count())
+
+    def test_rule_changes_reach_other_processes(self):
+        from drip.models import rule_plan_cache
+
+        model_drip = self.build_joined_date_drip()
+        self.assertEqual(2, model_drip.drip.get_queryset().count())
+        stale = rule_plan_cache.get(model_drip.pk)
+        self.assertIsNotNone(stale)
+
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='profile__credits',
+            lookup_type='gte',
+            field_value='5'
+        )
+        # another process still has the plan from before
+        rule_plan_cache.set(model_drip.pk, stale)
+        self.assertEqual(1, Drip.objects.get(pk=model_drip.pk).drip.get_queryset().count())
+
     def test_exclude_and_include(self):
         model_drip = Drip.objects.create(
             name='A Custom Week Ago',
@@ -306,6 +446,40 @@ class DripsTestCase(TestCase):
         self.assertEqual(unicode(response.content).count(admin.email), 1)
 
 
+    def test_timeline_matches_walk(self):
+        from drip.timeline import Timeline
+
+        model_drip = self.build_joined_date_drip()
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='profile__credits',
+            method_type='exclude',
+            lookup_type='exact',
+            field_value='0'
+        )
+        timeline = Timeline(model_drip.drip, into_past=3, into_future=10)
+
+        walked_user_ids = timeline.walk_user_ids()
+        with self.assertNumQueries(1):
+            user_ids = timeline.get_user_ids()
+        self.assertEqual(walked_user_ids, user_ids)
+        self.assertEqual([0, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0], [len(ids) for ids in user_ids])
+
+    def test_timeline_falls_back_to_walk(self):
+        from drip.timeline import Timeline
+
+        model_drip = self.build_joined_date_drip()
+        QuerySetRule.objects.create(
+            drip=model_drip,
+            field_name='sent_drips__date',
+            method_type='exclude',
+            lookup_type='gte',
+            field_value='now-1 days'
+        )
+        timeline = Timeline(model_drip.drip, into_past=3, into_future=2)
+        self.assertIsNone(timeline.time_field(model_drip.queryset_rules.get(field_name='sent_drips__date')))
+        self.assertEqual(timeline.walk_user_ids(), timeline.get_user_ids())
+
     ##################
     ### TEST M2M   ###
     ##################
@@ -478,3 +652,1140 @@ class CustomMessagesTest(TestCase):
         self.assertEqual(1, len(mail.outbox))
         email = mail.outbox.pop()
         self.assertIsInstance(email, mail.EmailMessage)
+
+
+class FlakyEmailBackend(LocmemEmailBackend):
+    """
+    Drops the connection on the first message it is asked to send.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FlakyEmailBackend, self).__init__(*args, **kwargs)
+        self.opened = 0
+        self.dropped = False
+
+    def open(self):
+        self.opened += 1
+
+    def send_messages(self, messages):
+        if not self.dropped:
+            self.dropped = True
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class FailingDripMessage(DripMessage):
+    """
+    Fails to render for batched_1.
+    """
+    failing_username = 'batched_1'
+
+    @property
+    def subject(self):
+        if self.user.username == self.failing_username:
+            raise RuntimeError('no subject for %s' % self.failing_username)
+        return super(FailingDripMessage, self).subject
+
+
+class BatchedSendTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Batched Drip',
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<b>KETTEHS ROCK!</b>'
+        )
+        for i in range(5):
+            self.User.objects.create(username='batched_%d' % i, email='batched_%d@example.com' % i)
+
+    def test_batched_send(self):
+        drip = self.model_drip.init_drip(DripBase, send_batch_size=2)
+        result = drip.send()
+        self.assertEqual(5, result)
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_batched_send_reconnects(self):
+        connection = FlakyEmailBackend()
+        drip = self.model_drip.init_drip(DripBase, send_batch_size=10)
+        drip.get_connection = lambda: connection
+
+        result = drip.send()
+        self.assertEqual(5, result)
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(2, connection.opened)
+
+    def get_failing_drip(self, **kwargs):
+        drip = self.model_drip.init_drip(DripBase, **kwargs)
+        drip.get_message_factory = lambda MessageClass: functools.partial(FailingDripMessage, drip)
+        return drip
+
+    def test_batched_send_skips_failed_renders(self):
+        result = self.get_failing_drip(send_batch_size=10).send()
+        self.assertEqual(4, result)
+        self.assertEqual(4, len(mail.outbox))
+        self.assertNotIn(['batched_1@example.com'], [email.to for email in mail.outbox])
+
+    def test_sent_drips_written_in_batches(self):
+        drip = self.model_drip.init_drip(DripBase, sent_drip_batch_size=2)
+        result = drip.send()
+        self.assertEqual(5, result)
+        self.assertEqual(5, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_sent_drips_flushed_when_sending_fails(self):
+        users = list(self.User.objects.filter(username__startswith='batched_'))
+
+        def broken_queryset():
+            for user in users[:2]:
+                yield user
+            raise RuntimeError('database went away')
+
+        drip = self.model_drip.init_drip(DripBase, sent_drip_batch_size=100)
+        drip.get_queryset = broken_queryset
+        self.assertRaises(RuntimeError, drip.send)
+        self.assertEqual(2, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_concurrent_send(self):
+        drip = self.model_drip.init_drip(DripBase, send_workers=3, send_queue_size=2)
+        result = drip.send()
+        self.assertEqual(5, result)
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(
+            sorted('batched_%d@example.com' % i for i in range(5)),
+            sorted(email.to[0] for email in mail.outbox))
+        self.assertEqual(5, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_concurrent_send_skips_failed_renders(self):
+        result = self.get_failing_drip(send_workers=2, send_queue_size=1).send()
+        self.assertEqual(4, result)
+        self.assertEqual(4, len(mail.outbox))
+        self.assertEqual(4, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_concurrent_send_without_connection(self):
+        def get_connection():
+            raise IOError('no backend')
+
+        drip = self.model_drip.init_drip(DripBase, send_workers=2, send_queue_size=1)
+        drip.get_connection = get_connection
+        self.assertRaises(IOError, drip.send)
+        self.assertEqual(0, len(mail.outbox))
+
+    def test_send_drips_command_with_workers(self):
+        from django.core.management import call_command
+        self.model_drip.enabled = True
+        self.model_drip.save()
+
+        call_command('send_drips', smtp=True, send_workers=2)
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual(5, SentDrip.objects.filter(drip=self.model_drip).count())
+
+
+class TemplateCacheTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Cached Drip',
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<b>KETTEHS ROCK, {{ user.username }}!</b>'
+        )
+        template_cache.clear()
+
+    def test_template_parsed_once(self):
+        self.assertIs(get_template('HELLO {{ user.username }}'),
+                      get_template('HELLO {{ user.username }}'))
+        self.assertEqual(1, len(template_cache))
+
+    def test_messages_share_compiled_templates(self):
+        drip = self.model_drip.drip
+        for i in range(3):
+            user = self.User.objects.create(username='cached_%d' % i, email='cached_%d@example.com' % i)
+            message = DripMessage(drip, user)
+            self.assertEqual('HELLO cached_%d' % i, message.subject)
+            self.assertIn('cached_%d' % i, message.body)
+        self.assertEqual(2, len(template_cache))
+
+    def test_changed_template_is_recompiled(self):
+        user = self.User.objects.create(username='cached', email='cached@example.com')
+        self.assertEqual('HELLO cached', DripMessage(self.model_drip.drip, user).subject)
+
+        self.model_drip.subject_template = 'BYE {{ user.username }}'
+        self.model_drip.save()
+        self.assertEqual('BYE cached', DripMessage(self.model_drip.drip, user).subject)
+
+
+def benchmark(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    print('%s: %.1f us per call' % (label, seconds / number * 1e6))
+    return seconds
+
+
+NEWSLETTER_TEMPLATE = '''
+<html><body>
+  <h1>Hello {{ user.username }}!</h1>
+  {% for i in items %}
+    <p>Paragraph {{ i }} of the newsletter for {{ user.email }} with <a href="http://example.com/{{ i }}">a link</a>.</p>
+  {% endfor %}
+  {% if user.is_staff %}<p>Psst, you are staff.</p>{% endif %}
+</body></html>
+'''
+
+
+@unittest.skipUnless(os.environ.get('DRIP_BENCHMARK'), 'set DRIP_BENCHMARK=1 to run benchmarks')
+class TemplateCacheBenchmark(TestCase):
+    def test_render_per_recipient(self):
+        user = get_user_model()(username='bench', email='bench@example.com')
+        context = Context({'user': user, 'items': range(20)})
+
+        before = benchmark('parse and render', lambda: Template(NEWSLETTER_TEMPLATE).render(context), 1000)
+        after = benchmark('cached render', lambda: get_template(NEWSLETTER_TEMPLATE).render(context), 1000)
+        self.assertLess(after, before)
+
+
+@unittest.skipUnless(os.environ.get('DRIP_BENCHMARK'), 'set DRIP_BENCHMARK=1 to run benchmarks')
+@unittest.skipIf(jinja2 is None, 'Jinja2 is not installed')
+class JinjaBenchmark(TestCase):
+    def test_render_per_recipient(self):
+        user = get_user_model()(username='bench', email='bench@example.com')
+        context = Context({'user': user, 'items': range(20)})
+
+        django_template = get_template(NEWSLETTER_TEMPLATE)
+        jinja_template = get_template(NEWSLETTER_TEMPLATE, 'jinja2')
+        self.assertEqual(django_template.render(context).split(), jinja_template.render(context).split())
+        benchmark('django render', lambda: django_template.render(context), 1000)
+        benchmark('jinja2 render', lambda: jinja_template.render(context), 1000)
+
+
+@unittest.skipUnless(os.environ.get('DRIP_BENCHMARK'), 'set DRIP_BENCHMARK=1 to run benchmarks')
+class PrebuiltMessageBenchmark(TestCase):
+    def test_serialize_per_recipient(self):
+        from drip.drips import SkeletonMessage
+
+        model_drip = Drip.objects.create(
+            name='Benchmark Drip', subject_template='Hello {{ user.username }}', body_html_template=NEWSLETTER_TEMPLATE)
+        drip = model_drip.get_drip()
+        users = [get_user_model()(username='bench_%d' % i, email='bench_%d@example.com' % i) for i in range(100)]
+        instances = [DripMessage(drip, user) for user in users]
+        make_message = SkeletonMessage(drip, DripMessage)
+        prepared = [make_message(user) for user in users]
+        for message_instance in instances + prepared:
+            message_instance.body, message_instance.plain, message_instance.subject
+
+        def serialize(message_instances):
+            for message_instance in message_instances:
+                message_instance._message = None
+                message_instance.message.message().as_bytes(linesep='\r\n')
+
+        benchmark('build and serialize 100 messages', lambda: serialize(instances), 10)
+        benchmark('fill in 100 prebuilt messages', lambda: serialize(prepared), 10)
+
+
+@unittest.skipUnless(os.environ.get('DRIP_BENCHMARK'), 'set DRIP_BENCHMARK=1 to run benchmarks')
+class PruneBenchmark(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        User.objects.bulk_create([User(username='prune_%d' % i, email='prune_%d@example.com' % i)
+                                  for i in range(2000)])
+        user_ids = list(User.objects.values_list('id', flat=True))
+        drips = [Drip.objects.create(name='Prune %d' % i, subject_template='HI', body_html_template='HI')
+                 for i in range(100)]
+        # every drip was sent to half the audience, 100k SentDrips in total
+        for drip in drips:
+            SentDrip.objects.bulk_create([SentDrip(drip=drip, user_id=user_id, subject='HI')
+                                          for user_id in user_ids[::2]])
+        self.model_drip = drips[0]
+
+    def test_prune(self):
+        def prune_with_in():
+            drip = self.model_drip.drip
+            target_user_ids = drip.get_queryset().values_list('id', flat=True)
+            exclude_user_ids = SentDrip.objects.filter(date__lt=timezone.now(),
+                                                       drip=self.model_drip,
+                                                       user__id__in=target_user_ids)\
+                                               .values_list('user_id', flat=True)
+            return drip.get_queryset().exclude(id__in=exclude_user_ids).count()
+
+        def prune_with_not_exists():
+            drip = self.model_drip.drip
+            drip.prune()
+            return drip.get_queryset().count()
+
+        self.assertEqual(prune_with_in(), prune_with_not_exists())
+        benchmark('prune with IN', prune_with_in, 10)
+        benchmark('prune with NOT EXISTS', prune_with_not_exists, 10)
+
+
+class UnsubscribeLinkNode(Node):
+    def render(self, context):
+        return '/unsubscribe/%s/' % context['user'].pk
+
+
+class TemplateQueryPlanTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Credits Drip',
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<p>You have {{ user.profile.credits }} credits'
+                               '{% for group in user.groups.all %}, {{ group.name }}{% endfor %}.</p>'
+        )
+
+    def test_variable_paths(self):
+        from drip.rendering import get_variable_paths
+
+        template = Template('{% if user.is_staff %}{{ user.profile.credits|default:user.pk }}{% endif %}')
+        self.assertEqual(set([('is_staff',), ('profile', 'credits'), ('pk',)]), get_variable_paths(template))
+        self.assertIsNone(get_variable_paths(Template('{% include "drip/timeline.html" %}')))
+        self.assertIsNone(get_variable_paths(Template('{% debug %}')))
+
+        # custom tags may take the user from the context
+        template = Template('<p>Hi</p>')
+        template.nodelist.append(UnsubscribeLinkNode())
+        self.assertIsNone(get_variable_paths(template))
+
+    def test_related_lookups(self):
+        from drip.utils import get_related_lookups
+
+        select_related, prefetch_related, only = get_related_lookups(
+            self.User, [('username',), ('profile', 'credits'), ('groups', 'all')])
+        self.assertEqual(set(['profile']), select_related)
+        self.assertEqual(set(['groups']), prefetch_related)
+        self.assertEqual(set(['id', 'username']), only)
+
+        self.assertIsNone(get_related_lookups(self.User, [('get_full_name',)])[2])
+
+    def send_and_count_queries(self, users):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        start = self.User.objects.count()
+        for i in range(start, start + users):
+            self.User.objects.create(username='credits_%d' % i, email='credits_%d@example.com' % i)
+        SentDrip.objects.all().delete()
+        mail.outbox = []
+
+        drip = Drip.objects.get(id=self.model_drip.id).drip
+        drip.get_queryset()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.User.objects.count(), drip.send())
+        return len(queries)
+
+    def test_queries_do_not_grow_with_audience(self):
+        self.assertEqual(self.send_and_count_queries(2), self.send_and_count_queries(8))
+
+    def test_all_fields_for_custom_message_classes(self):
+        self.assertEqual(set(['id', 'username', 'email']),
+                         self.model_drip.drip.get_queryset().query.deferred_loading[0])
+
+        self.model_drip.message_class = 'plain'
+        with self.settings(DRIP_MESSAGE_CLASSES={'plain': 'drip.tests.PlainDripEmail'}):
+            self.assertEqual(set(), self.model_drip.drip.get_queryset().query.deferred_loading[0])
+
+
+class PlainTextTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model()(username='<plain>', email='plain@example.com')
+
+    def assertPlainMatchesStripTags(self, source, has_markup):
+        from django.utils.html import strip_tags
+        from drip.rendering import get_plain_template
+
+        context = Context({'user': self.user, 'items': ['<i>one</i>', 'two'], 'link': '<a href="/">home</a>'})
+        plain_template, found_markup = get_plain_template(source)
+        self.assertIsNotNone(plain_template)
+        self.assertEqual(has_markup, found_markup)
+        self.assertEqual(strip_tags(Template(source).render(context)), plain_template.render(context))
+
+    def test_plain_text(self):
+        self.assertPlainMatchesStripTags('Hello {{ user.username }}, no markup here.', False)
+        self.assertPlainMatchesStripTags(NEWSLETTER_TEMPLATE, True)
+        self.assertPlainMatchesStripTags(
+            '<p class="{{ user.username }}">Hi<!-- {{ user.email }} -->, {{ link|safe }}</p>', True)
+        self.assertPlainMatchesStripTags(
+            '<ul>{% for item in items %}<li title="{{ item }}">{{ item|safe }}</li>{% endfor %}</ul>', True)
+
+    def test_quoted_attributes(self):
+        self.assertPlainMatchesStripTags('<a title="a>b" href="{{ user.username }}">Go</a>', True)
+        self.assertPlainMatchesStripTags(
+            "<p data-x='1 > 0' class=\"{% if user %}x{% endif %}\">{{ user.username }} > all</p>", True)
+        self.assertPlainMatchesStripTags('<img alt = "{{ link }}>" src=x>{{ link|safe }}', True)
+
+    def test_markup_across_nodes_falls_back(self):
+        from django.utils.html import strip_tags
+        from drip.rendering import get_plain_template
+
+        self.user.first_name = 'A & B'
+        for source in ('x<{{ user.first_name }}>y', '<<b>b>{{ user.username }}'):
+            self.assertEqual((None, False), get_plain_template(source))
+
+            message = DripMessage(Drip(name='Tricky', subject_template='HI', body_html_template=source).drip,
+                                  self.user)
+            self.assertEqual(strip_tags(message.body), message.plain)
+            self.assertTrue(message.is_html)
+
+    def test_conditional_markup_falls_back(self):
+        from drip.rendering import get_plain_template
+        self.assertEqual((None, False), get_plain_template('<a {% if user %}href="/">{% else %}>{% endif %}x</a>'))
+
+    def test_html_alternative(self):
+        drip = Drip.objects.create(name='Plain Drip', subject_template='HI', body_html_template='{{ link|safe }}').drip
+        message = DripMessage(drip, self.user)
+        message._context = Context({'user': self.user, 'link': 'no markup'})
+        self.assertFalse(message.is_html)
+
+        message = DripMessage(drip, self.user)
+        message._context = Context({'user': self.user, 'link': '<b>markup</b>'})
+        self.assertTrue(message.is_html)
+        self.assertEqual('markup', message.plain)
+
+
+class BroadcastTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='An Announcement',
+            subject_template='Big news',
+            body_html_template='<h1>We are live!</h1>'
+        )
+        for i in range(3):
+            self.User.objects.create(username='broadcast_%d' % i, email='broadcast_%d@example.com' % i)
+
+    def test_broadcast_is_opt_in(self):
+        from drip.drips import BroadcastMessage
+
+        # tags may look at the user without the templates saying so
+        self.assertNotIsInstance(self.model_drip.drip.get_message_factory(DripMessage), BroadcastMessage)
+        self.assertIsInstance(self.model_drip.get_drip(broadcast=True).get_message_factory(DripMessage),
+                              BroadcastMessage)
+
+    def test_broadcast_skips_failed_first_render(self):
+        from drip.drips import BroadcastMessage
+
+        class FirstFailingMessage(FailingDripMessage):
+            failing_username = 'broadcast_0'
+
+        drip = self.model_drip.get_drip(broadcast=True, send_batch_size=10)
+        drip.get_message_factory = lambda MessageClass: BroadcastMessage(drip, FirstFailingMessage)
+        self.assertEqual(2, drip.send())
+        self.assertEqual(
+            ['broadcast_1@example.com', 'broadcast_2@example.com'],
+            sorted(email.to[0] for email in mail.outbox))
+        self.assertEqual(2, SentDrip.objects.filter(drip=self.model_drip, subject='Big news').count())
+
+    def test_broadcast_send(self):
+        self.assertEqual(3, self.model_drip.get_drip(broadcast=True).send())
+        self.assertEqual(3, SentDrip.objects.filter(drip=self.model_drip, subject='Big news').count())
+
+        messages = [email.message() for email in mail.outbox]
+        self.assertEqual(
+            sorted('broadcast_%d@example.com' % i for i in range(3)),
+            sorted(message['To'] for message in messages))
+        self.assertEqual(3, len(set(message['Message-ID'] for message in messages)))
+
+        serialized = messages[0].as_bytes()
+        self.assertIn(b'To: ' + messages[0]['To'].encode('ascii'), serialized)
+        self.assertIn(b'<h1>We are live!</h1>', serialized)
+        self.assertNotIn(b'drip-slot', serialized)
+        self.assertEqual(
+            serialized.replace(messages[0]['To'].encode('ascii'), b'')
+                      .replace(messages[0]['Message-ID'].encode('ascii'), b'')
+                      .replace(messages[0]['Date'].encode('ascii'), b''),
+            messages[1].as_bytes().replace(messages[1]['To'].encode('ascii'), b'')
+                                  .replace(messages[1]['Message-ID'].encode('ascii'), b'')
+                                  .replace(messages[1]['Date'].encode('ascii'), b''))
+
+
+class BuiltinBackendsTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Drip To Write Out',
+            subject_template='Hello',
+            body_html_template='<p>Hi {{ user.username }}, nice to have you.</p>',
+        )
+        for i in range(3):
+            self.User.objects.create(username='written_%d' % i, email='written_%d@example.com' % i)
+
+    def send(self, connection, **kwargs):
+        drip = self.model_drip.get_drip(send_batch_size=10, **kwargs)
+        drip.get_connection = lambda: connection
+        SentDrip.objects.all().delete()
+        return drip.send()
+
+    def test_console_backend(self):
+        from django.core.mail.backends.console import EmailBackend
+        from django.utils.six import StringIO
+
+        for kwargs in ({'broadcast': True}, {'prebuild_messages': True}):
+            stream = StringIO()
+            self.assertEqual(3, self.send(EmailBackend(stream=stream), **kwargs))
+            for i in range(3):
+                self.assertIn('To: written_%d@example.com' % i, stream.getvalue())
+
+    def test_file_backend(self):
+        import shutil
+        import tempfile
+        from django.core.mail.backends.filebased import EmailBackend
+
+        for kwargs in ({'broadcast': True}, {'prebuild_messages': True}):
+            file_path = tempfile.mkdtemp()
+            try:
+                self.assertEqual(3, self.send(EmailBackend(file_path=file_path), **kwargs))
+                written = b''.join(open(os.path.join(file_path, name), 'rb').read()
+                                   for name in os.listdir(file_path))
+            finally:
+                shutil.rmtree(file_path)
+            for i in range(3):
+                self.assertIn(b'To: written_%d@example.com' % i, written)
+
+
+class PrerenderTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model()(username='<pre>', email='pre@example.com')
+
+    def assertPrerendersLikeTemplate(self, source):
+        from drip.rendering import get_template_skeleton
+
+        skeleton = get_template_skeleton(source)
+        self.assertIsNotNone(skeleton)
+        context = Context({'user': self.user})
+        self.assertEqual(Template(source).render(context), skeleton.render(context))
+        self.assertTrue(context.autoescape)
+
+    def test_prerender(self):
+        self.assertPrerendersLikeTemplate('Hello {{ user.username }}, {{ user.email }}')
+        self.assertPrerendersLikeTemplate(
+            '<b>{{ user.username }}</b>{% autoescape off %}<i>{{ user.username }}</i>{% endautoescape %}')
+        self.assertPrerendersLikeTemplate('{% for i in "abc" %}{{ i }}: {{ user.get_username }} {% endfor %}')
+        self.assertPrerendersLikeTemplate('Nobody knows {{ user.nothing }}')
+
+    def test_templates_without_skeleton(self):
+        from drip.rendering import get_template_skeleton
+
+        self.assertIsNone(get_template_skeleton('{% if user.is_staff %}staff{% endif %}'))
+        self.assertIsNone(get_template_skeleton('{{ user.username|upper }}'))
+        self.assertIsNone(get_template_skeleton('{{ user.profile.credits }}'))
+        self.assertIsNone(get_template_skeleton('{% filter upper %}{{ user.username }}{% endfilter %}'))
+
+    def test_prerendered_messages(self):
+        model_drip = Drip.objects.create(
+            name='A Prerendered Drip',
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<p>{{ greeting }} {{ user.greeting }}, {{ user.username }}</p>'
+        )
+        message = DripMessage(model_drip.get_drip(prerender_templates=True), self.user)
+        self.assertEqual('HELLO &lt;pre&gt;', message.subject)
+        self.assertEqual('<p> , &lt;pre&gt;</p>', message.body)
+
+        # prerendering changes nothing about the message
+        message = DripMessage(model_drip.drip, self.user)
+        self.assertEqual('HELLO &lt;pre&gt;', message.subject)
+        self.assertEqual('<p> , &lt;pre&gt;</p>', message.body)
+
+    def test_custom_context(self):
+        model_drip = Drip.objects.create(
+            name='A Prerendered Drip',
+            subject_template='HELLO {{ user.username }}',
+            body_html_template='<a href="/unsub/{{ token }}">{{ user.username }}</a>'
+        )
+        message = TokenDripMessage(model_drip.get_drip(prerender_templates=True), self.user)
+        self.assertEqual('<a href="/unsub/tok-None">&lt;pre&gt;</a>', message.body)
+
+
+@unittest.skipIf(jinja2 is None, 'Jinja2 is not installed')
+class JinjaTemplateTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='<jinja>', email='jinja@example.com')
+        self.model_drip = Drip.objects.create(
+            name='A Jinja Drip',
+            subject_template='Hi {{ user.username }}',
+            body_html_template='{% if user.email %}<b>{{ user.username|upper }}</b>{% endif %}',
+            template_engine='jinja2',
+        )
+
+    def test_render(self):
+        message = DripMessage(self.model_drip.drip, self.user)
+        self.assertEqual('Hi &lt;jinja&gt;', message.subject)
+        self.assertEqual('<b>&lt;JINJA&gt;</b>', message.body)
+        self.assertEqual('&lt;JINJA&gt;', message.plain)
+        self.assertTrue(message.is_html)
+
+    def test_compiled_once_per_source(self):
+        self.assertIs(get_template('{{ user }}', 'jinja2'), get_template('{{ user }}', 'jinja2'))
+        self.assertIsNot(get_template('{{ user }}', 'jinja2'), get_template('{{ user }}'))
+
+    def test_send(self):
+        drip = self.model_drip.drip
+        self.assertIsNone(drip.get_template_variable_paths())
+        self.assertEqual(1, drip.send())
+        self.assertEqual('Hi &lt;jinja&gt;', mail.outbox[0].subject)
+
+
+class TokenDripMessage(DripMessage):
+    """
+    Renders its templates with an unsubscribe token for the user.
+    """
+    @property
+    def context(self):
+        if not self._context:
+            self._context = Context({'user': self.user, 'token': 'tok-%s' % self.user.pk})
+        return self._context
+
+
+class PrebuiltMessageTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Prebuilt Drip',
+            subject_template='Hello {{ user.username }}',
+            body_html_template='<p>Hi {{ user.username }}, nice to have you.</p>',
+        )
+        self.User.objects.create(username='prebuilt', email='prebuilt@example.com')
+        self.User.objects.create(username='pr\xe9built', email='prebuilt_2@example.com')
+        self.User.objects.create(username='prebuilt_' + 'x' * 80, email='prebuilt_3@example.com')
+
+    def serialize(self, message):
+        # everything but what differs between any two messages
+        return re.sub(br'(Message-ID|Date): [^\r]*|=+\d+==', b'', message.as_bytes(linesep='\r\n'))
+
+    def test_matches_messages_built_per_user(self):
+        drip = self.model_drip.get_drip(prebuild_messages=True)
+        self.assertEqual(3, drip.send())
+        self.assertEqual(3, len(mail.outbox))
+
+        for email in mail.outbox:
+            user = self.User.objects.get(email=email.to[0])
+            self.assertEqual('Hello %s' % user.username, email.subject)
+            expected = DripMessage(self.model_drip.drip, user).message
+            self.assertEqual(self.serialize(expected.message()), self.serialize(email.message()))
+
+    def test_date_of_every_message(self):
+        from drip import mime
+
+        make_message = self.model_drip.get_drip(prebuild_messages=True).get_message_factory(DripMessage)
+        users = list(self.User.objects.order_by('pk'))
+        make_message(users[0]).message.message()
+
+        formatdate = mime.formatdate
+        mime.formatdate = lambda: 'Tue, 01 Jan 2030 00:00:00 -0000'
+        try:
+            message = make_message(users[2]).message.message()
+        finally:
+            mime.formatdate = formatdate
+        self.assertEqual('Tue, 01 Jan 2030 00:00:00 -0000', message['Date'])
+        self.assertIn(b'Date: Tue, 01 Jan 2030 00:00:00 -0000', message.as_bytes())
+
+    def test_static_subject(self):
+        self.model_drip.subject_template = 'Hello there'
+        drip = self.model_drip.get_drip(prebuild_messages=True)
+        self.assertEqual(3, drip.send())
+        self.assertEqual(set(['Hello there']), set(email.message()['Subject'] for email in mail.outbox))
+
+    def test_custom_context(self):
+        self.model_drip.subject_template = 'Hello there'
+        self.model_drip.body_html_template = '<a href="/unsub/{{ token }}">Unsubscribe</a>'
+        drip = self.model_drip.get_drip(prebuild_messages=True)
+        drip.get_message_factory = lambda MessageClass: DripBase.get_message_factory(drip, TokenDripMessage)
+        self.assertEqual(3, drip.send())
+
+        for email in mail.outbox:
+            user = self.User.objects.get(email=email.to[0])
+            self.assertIn(('/unsub/tok-%s' % user.pk).encode('ascii'), email.message().as_bytes())
+
+    def test_skips_failed_renders(self):
+        class FirstFailingMessage(FailingDripMessage):
+            failing_username = 'prebuilt'
+
+        drip = self.model_drip.get_drip(prebuild_messages=True, send_batch_size=10)
+        drip.get_message_factory = lambda MessageClass: DripBase.get_message_factory(drip, FirstFailingMessage)
+        self.assertEqual(2, drip.send())
+        self.assertEqual(
+            ['prebuilt_2@example.com', 'prebuilt_3@example.com'],
+            sorted(email.to[0] for email in mail.outbox))
+
+
+class MailgunResponse(object):
+    def __init__(self, ok=True, status_code=None):
+        self.ok = ok
+        self.status_code = status_code or (200 if ok else 400)
+
+
+class MailgunSendTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Mailgun Drip',
+            subject_template='Hello',
+            body_html_template='<p>Hello {{ user.username }}</p>',
+            template_base='standalone',
+        )
+        for i in range(5):
+            self.User.objects.create(username='mailgun_%d' % i, email='mailgun_%d@example.com' % i)
+        self.User.objects.create(username='mailgun_no_email', email='')
+        self.batches = []
+
+    def get_drip(self, post):
+        drip = self.model_drip.init_drip(
+            DripMailgun,
+            tags_list=[],
+            template_base='standalone',
+            base_template_html_path=None,
+            drip_instance=self.model_drip,
+            post=post,
+        )
+        drip.MAILGUN_BATCHSIZE = 2
+        return drip
+
+    def post(self, url, auth, data):
+        self.batches.append(sorted(data['to']))
+        # users joining while sending wait for the next run
+        self.User.objects.create(username='late_%d' % len(self.batches), email='late@example.com')
+        return MailgunResponse(ok=len(self.batches) != 2)
+
+    def test_sent_drips_for_accepted_batches_only(self):
+        self.assertEqual(3, self.get_drip(self.post).send())
+
+        self.assertEqual([
+            ['mailgun_0@example.com', 'mailgun_1@example.com'],
+            ['mailgun_2@example.com', 'mailgun_3@example.com'],
+            ['mailgun_4@example.com'],
+        ], self.batches)
+        self.assertEqual(
+            set(['mailgun_0', 'mailgun_1', 'mailgun_4']),
+            set(SentDrip.objects.filter(drip=self.model_drip).values_list('user__username', flat=True)))
+
+    def test_sent_drips_written_with_their_batch(self):
+        from drip.models import MailgunBatch
+
+        written = []
+
+        def post(url, auth, data):
+            written.append((
+                SentDrip.objects.filter(drip=self.model_drip).count(),
+                list(MailgunBatch.objects.filter(drip=self.model_drip).values_list('status', flat=True))))
+            return MailgunResponse()
+
+        self.assertEqual(5, self.get_drip(post).send())
+        self.assertEqual([
+            (0, ['pending']),
+            (2, ['accepted', 'pending']),
+            (4, ['accepted', 'accepted', 'pending']),
+        ], written)
+
+    def test_batches_are_built_as_needed(self):
+        from drip import mailgun
+
+        taken = []
+
+        def numbers():
+            for i in range(5):
+                taken.append(i)
+                yield i
+
+        batches = mailgun.batches(numbers(), 2)
+        self.assertEqual([0, 1], next(batches))
+        self.assertEqual([0, 1], taken)
+        self.assertEqual([[2, 3], [4]], list(batches))
+
+    def test_send_batch(self):
+        from drip import mailgun
+
+        recipient_variables_dict = dict(('mailgun_%d@example.com' % i, {'id': i}) for i in range(5))
+        responses = mailgun.send_batch(
+            subject='Hello', template_html='<p>Hello</p>', template_plain='Hello',
+            recipient_variables_dict=recipient_variables_dict, from_email='drip@example.com', tags_list=[],
+            mailgun_api_key='key', mailgun_domain='example.com', mailgun_batchsize=2, post=self.post,
+            url_template='https://api.mailgun.net/v3/{0}/messages')
+        self.assertEqual([True, False, True], [response.ok for response in responses])
+        self.assertEqual(sorted(recipient_variables_dict), sorted(sum(self.batches, [])))
+
+    def test_invalid_emails_are_skipped(self):
+        self.User.objects.filter(username='mailgun_1').update(email='not an address')
+        self.User.objects.filter(username='mailgun_3').update(email='mailgun@@example.com')
+        drip = self.get_drip(lambda url, auth, data: self.batches.append(sorted(data['to'])) or MailgunResponse())
+
+        self.assertEqual(3, drip.send())
+        self.assertEqual(['not an address', 'mailgun@@example.com'], drip.invalid_emails)
+        self.assertEqual([
+            ['mailgun_0@example.com', 'mailgun_2@example.com'],
+            ['mailgun_4@example.com'],
+        ], self.batches)
+        self.assertFalse(EmailValidation.objects.get(email='not an address').is_valid)
+        self.assertTrue(EmailValidation.objects.get(email='mailgun_0@example.com').is_valid)
+
+    def test_email_validation_is_remembered(self):
+        emails = ['valid@example.com', 'invalid@', 'valid@example.com']
+        self.assertEqual((['valid@example.com', 'valid@example.com'], ['invalid@']),
+                         EmailValidation.partition(emails))
+        self.assertEqual(2, EmailValidation.objects.count())
+
+        # known addresses take a single query, and no validating
+        with self.assertNumQueries(1):
+            self.assertEqual((['valid@example.com', 'valid@example.com'], ['invalid@']),
+                             EmailValidation.partition(emails))
+
+    def test_send_batch_drops_invalid_emails(self):
+        from drip import mailgun
+
+        recipient_variables_dict = {'valid@example.com': {}, 'invalid@': {}}
+        responses = mailgun.send_batch(
+            subject='Hello', template_html='<p>Hello</p>', template_plain='Hello',
+            recipient_variables_dict=recipient_variables_dict, from_email='drip@example.com', tags_list=[],
+            mailgun_api_key='key', mailgun_domain='example.com', mailgun_batchsize=1,
+            post=lambda url, auth, data: self.batches.append(data['to']) or MailgunResponse(),
+            url_template='https://api.mailgun.net/v3/{0}/messages')
+        self.assertEqual([['valid@example.com']], self.batches)
+        self.assertEqual(2, len(responses))
+
+    def test_concurrent_batches_in_order(self):
+        from drip import mailgun
+
+        def post(url, auth, data):
+            # later batches finish first
+            time.sleep(0.01 * (10 - len(data['to'])))
+            return MailgunResponse()
+
+        recipient_batches = [dict(('%d_%d@example.com' % (i, j), {}) for j in range(i)) for i in range(1, 10)]
+        results = list(mailgun.send_batches(
+            iter(recipient_batches), concurrency=4,
+            subject='Hello', template_html='<p>Hello</p>', template_plain='Hello', from_email='drip@example.com',
+            tags_list=[], mailgun_api_key='key', mailgun_domain='example.com', post=post,
+            url_template='https://api.mailgun.net/v3/{0}/messages'))
+        self.assertEqual(recipient_batches, [batch for batch, response in results])
+
+
+class MailgunStandIn(BaseHTTPServer.HTTPServer):
+    """
+    Answers posts to any url like the Mailgun messages endpoint does,
+    with the next of `statuses` or 200 once there are none left, and
+    stores, looks up and deletes template versions like the templates
+    endpoint does.
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def template_path(self):
+            # the template name and version tag of a templates url, if any
+            path = self.path.split('?', 1)[0]
+            if '/templates' not in path:
+                return None
+            rest = path.split('/templates', 1)[1].strip('/').split('/')
+            return rest[0], rest[2] if len(rest) > 2 else None
+
+        def do_POST(self):
+            body = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            template_path = self.template_path()
+            if template_path is not None:
+                name = template_path[0] or body['name'][0]
+                tag = body['tag'][0]
+                self.server.templates.setdefault(name, {})[tag] = body['template'][0]
+                self.server.active_versions[name] = tag
+                self.server.template_posts.append((name, tag))
+                return self.respond(200, b'{"message": "template has been stored"}')
+            self.server.posts.append(body)
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            self.respond(status, b'{"message": "Queued. Thank you."}')
+
+        def do_GET(self):
+            name, tag = self.template_path() or (None, None)
+            versions = self.server.templates.get(name)
+            if versions and tag is None:
+                return self.respond(200, json.dumps({'template': {
+                    'name': name, 'version': {'tag': self.server.active_versions[name]}}}).encode('utf-8'))
+            if versions and tag in versions:
+                return self.respond(200, b'{"template": {}}')
+            self.respond(404, b'{"message": "template not found"}')
+
+        def do_DELETE(self):
+            name, tag = self.template_path()
+            self.server.templates[name].pop(tag)
+            self.respond(200, b'{"message": "version has been deleted"}')
+
+        def respond(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, statuses=()):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+        self.statuses = list(statuses)
+        self.posts = []
+        self.templates = {}
+        self.active_versions = {}
+        self.template_posts = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url_template(self):
+        return 'http://127.0.0.1:%d/v3/{0}/messages' % self.server_port
+
+    @property
+    def templates_url_template(self):
+        return 'http://127.0.0.1:%d/v3/{0}/templates' % self.server_port
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MailgunClientTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Resumed Drip',
+            enabled=True,
+            subject_template='Hello',
+            body_html_template='<p>Hello {{ user.username }}</p>',
+            template_base='standalone',
+        )
+        for i in range(5):
+            self.User.objects.create(username='resumed_%d' % i, email='resumed_%d@example.com' % i)
+
+    def run_drip(self, statuses):
+        server = MailgunStandIn(statuses)
+        try:
+            drip = self.model_drip.init_drip(
+                DripMailgun,
+                tags_list=[],
+                template_base='standalone',
+                base_template_html_path=None,
+                drip_instance=self.model_drip,
+            )
+            drip.MAILGUN_BATCHSIZE = 2
+            drip.MAILGUN_RETRY_BACKOFF = 0
+            drip.MAILGUN_SEND_MESSAGE_ENDPOINT_TEMPLATE = server.url_template
+            return drip.run(), [sorted(post['to']) for post in server.posts]
+        finally:
+            server.stop()
+
+    def test_retries_and_resumes_failed_batches(self):
+        from drip.models import MailgunBatch
+
+        # throttled once, then the second batch fails for good
+        count, posts = self.run_drip([429, 200, 500, 500, 500, 503])
+        self.assertEqual(3, count)
+        self.assertEqual([
+            ['resumed_0@example.com', 'resumed_1@example.com'],
+            ['resumed_0@example.com', 'resumed_1@example.com'],
+            ['resumed_2@example.com', 'resumed_3@example.com'],
+            ['resumed_2@example.com', 'resumed_3@example.com'],
+            ['resumed_2@example.com', 'resumed_3@example.com'],
+            ['resumed_2@example.com', 'resumed_3@example.com'],
+            ['resumed_4@example.com'],
+        ], posts)
+        self.assertEqual(['accepted', 'failed', 'accepted'],
+                         list(MailgunBatch.objects.order_by('pk').values_list('status', flat=True)))
+
+        # only the failed batch is posted again
+        count, posts = self.run_drip([])
+        self.assertEqual(2, count)
+        self.assertEqual([['resumed_2@example.com', 'resumed_3@example.com']], posts)
+        self.assertFalse(MailgunBatch.objects.exclude(status='accepted').exists())
+        self.assertEqual(5, SentDrip.objects.filter(drip=self.model_drip).count())
+
+    def test_stored_template(self):
+        server = MailgunStandIn()
+        try:
+            def send():
+                drip = self.model_drip.init_drip(
+                    DripMailgun,
+                    tags_list=[],
+                    template_base='standalone',
+                    base_template_html_path=None,
+                    drip_instance=self.model_drip,
+                )
+                drip.variables = ('username',)
+                drip.MAILGUN_BATCHSIZE = 2
+                drip.MAILGUN_USE_STORED_TEMPLATES = True
+                drip.MAILGUN_SEND_MESSAGE_ENDPOINT_TEMPLATE = server.url_template
+                drip.MAILGUN_TEMPLATES_ENDPOINT_TEMPLATE = server.templates_url_template
+                SentDrip.objects.all().delete()
+                return drip.send()
+
+            self.assertEqual(5, send())
+            name = 'drip-%d' % self.model_drip.pk
+            self.assertEqual(1, len(server.template_posts))
+            self.assertEqual(name, server.template_posts[0][0])
+            version = server.template_posts[0][1]
+            self.assertIn('%recipient.username%', server.templates[name][version])
+            self.assertEqual(3, len(server.posts))
+            for post in server.posts:
+                self.assertEqual([name], post['template'])
+                self.assertEqual([version], post['t:version'])
+                self.assertEqual(['yes'], post['t:text'])
+                self.assertNotIn('html', post)
+                self.assertNotIn('text', post)
+
+            # the same revision is not uploaded again, a new one replaces it
+            self.assertEqual(5, send())
+            self.assertEqual(1, len(server.template_posts))
+            self.model_drip.body_html_template = '<p>Bye {{ user.username }}</p>'
+            self.model_drip.save()
+            self.assertEqual(5, send())
+            self.assertEqual(2, len(server.template_posts))
+            self.assertEqual(name, server.template_posts[1][0])
+            new_version = server.template_posts[1][1]
+            self.assertNotEqual(version, new_version)
+            self.assertEqual([new_version], list(server.templates[name]))
+            self.assertEqual([new_version], server.posts[-1]['t:version'])
+        finally:
+            server.stop()
+
+    def test_rejected_and_unknown_batches_wait(self):
+        from drip.models import MailgunBatch
+
+        # the second batch is rejected for good
+        count, posts = self.run_drip([200, 400])
+        self.assertEqual(3, count)
+        self.assertEqual(3, len(posts))
+        rejected = MailgunBatch.objects.get(status='rejected')
+        self.assertEqual(400, rejected.status_code)
+
+        # a send that broke off left a batch pending
+        unknown = MailgunBatch.objects.create(
+            drip=self.model_drip, user_ids='[%d]' % self.User.objects.create(
+                username='resumed_5', email='resumed_5@example.com').pk,
+            recipient_variables='{"resumed_5@example.com": {}}')
+
+        # neither is posted again, nor are their users in new batches
+        count, posts = self.run_drip([])
+        self.assertEqual(0, count)
+        self.assertEqual([], posts)
+        self.assertEqual('unknown', MailgunBatch.objects.get(pk=unknown.pk).status)
+
+        # until told to
+        MailgunBatch.objects.get(pk=rejected.pk).retry()
+        MailgunBatch.objects.get(pk=unknown.pk).mark_accepted()
+        count, posts = self.run_drip([])
+        self.assertEqual(2, count)
+        self.assertEqual([['resumed_2@example.com', 'resumed_3@example.com']], posts)
+        self.assertEqual(6, SentDrip.objects.filter(drip=self.model_drip).count())
+        self.assertFalse(MailgunBatch.objects.exclude(status='accepted').exists())
+
+    def test_template_lookup_goes_through_client(self):
+        requests = []
+
+        def get(url, auth, params=None):
+            requests.append(('GET', url))
+            # throttled once, then not found
+            return MailgunResponse(ok=False, status_code=429 if len(requests) == 1 else 404)
+
+        def post(url, auth, data):
+            requests.append(('POST', url))
+            return MailgunResponse()
+
+        drip = self.model_drip.init_drip(
+            DripMailgun,
+            tags_list=[],
+            template_base='standalone',
+            base_template_html_path=None,
+            drip_instance=self.model_drip,
+            post=post,
+            get=get,
+        )
+        drip.MAILGUN_BATCHSIZE = 5
+        drip.MAILGUN_RETRY_BACKOFF = 0
+        drip.MAILGUN_USE_STORED_TEMPLATES = True
+        drip.MAILGUN_TEMPLATES_ENDPOINT_TEMPLATE = 'https://api.mailgun.net/v3/{0}/templates'
+        self.assertEqual(5, drip.send())
+
+        templates_url = 'https://api.mailgun.net/v3/%s/templates' % drip.MAILGUN_DOMAIN
+        self.assertEqual(['GET', 'GET', 'GET', 'POST', 'POST'], [method for method, url in requests])
+        self.assertTrue(requests[0][1].startswith(templates_url + '/drip-%d/versions/' % self.model_drip.pk))
+        self.assertEqual(templates_url, requests[3][1])
+
+    def test_token_bucket(self):
+        from drip import mailgun
+
+        now = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        bucket = mailgun.TokenBucket(rate=2, capacity=2, clock=lambda: now[0], sleep=sleep)
+        for i in range(4):
+            bucket.acquire()
+        self.assertEqual([0.5, 0.5], waits)
+
+
+class GreetingBatchMessage(MailgunBatchMessage):
+    def get_var_greeting(self, user):
+        return 'Hi %s' % user.username
+
+
+class FollowersBatchMessage(GreetingBatchMessage):
+    calls = []
+
+    def get_vars_followers(self, users):
+        self.calls.append(sorted(user.username for user in users))
+        return dict((user.pk, len(user.username)) for user in users if user.username != 'variable_0')
+
+    def get_var_followers(self, user):
+        return 'unknown'
+
+
+class VariablePlanTest(TestCase):
+    def setUp(self):
+        self.User = get_user_model()
+        self.model_drip = Drip.objects.create(
+            name='A Variable Drip', subject_template='Hello', body_html_template='Hello', template_base='standalone')
+        for i in range(3):
+            self.User.objects.create(username='variable_%d' % i, email='variable_%d@example.com' % i,
+                                     first_name='First %d' % i if i else '')
+        self.drip = self.model_drip.init_drip(
+            DripMailgun,
+            tags_list=[],
+            template_base='standalone',
+            base_template_html_path=None,
+            drip_instance=self.model_drip,
+        )
+        # compiles the rules
+        self.drip.get_queryset()
+
+    def get_variables(self, MessageClass, variables, strict=True):
+        self.drip.variables = variables
+        return MessageClass(self.drip).get_variables(strict=strict)
+
+    def test_columns_read_with_values(self):
+        with self.assertNumQueries(1):
+            variables = self.get_variables(MailgunBatchMessage, ('username', 'id'))
+        user = self.User.objects.get(username='variable_1')
+        self.assertEqual({'username': 'variable_1', 'id': user.pk}, variables['variable_1@example.com'])
+
+    def test_falsy_values(self):
+        self.assertRaises(ValueError, self.get_variables, MailgunBatchMessage, ('first_name',))
+        variables = self.get_variables(MailgunBatchMessage, ('first_name',), strict=False)
+        self.assertEqual({'first_name': ''}, variables['variable_0@example.com'])
+        self.assertEqual({'first_name': 'First 1'}, variables['variable_1@example.com'])
+
+    def test_attributes_and_hooks(self):
+        variables = self.get_variables(GreetingBatchMessage, ('greeting', 'get_full_name', 'username'))
+        self.assertEqual({
+            'greeting': 'Hi variable_2',
+            'get_full_name': 'First 2',
+            'username': 'variable_2',
+        }, variables['variable_2@example.com'])
+
+        user = self.User.objects.get(username='variable_2')
+        plan = GreetingBatchMessage(self.drip).get_variable_plan()
+        self.assertIs(plan, GreetingBatchMessage(self.drip).get_variable_plan())
+        self.assertEqual(variables['variable_2@example.com'],
+                         GreetingBatchMessage(self.drip).mailgun_variables_for_user(user))
+
+    def test_batch_hooks(self):
+        FollowersBatchMessage.calls = []
+        self.drip.queryset_page_size = 2
+        variables = self.get_variables(FollowersBatchMessage, ('followers', 'greeting'))
+
+        self.assertEqual([['variable_0', 'variable_1'], ['variable_2']], FollowersBatchMessage.calls)
+        # get_var_ covers what get_vars_ leaves out
+        self.assertEqual({'followers': 'unknown', 'greeting': 'Hi variable_0'}, variables['variable_0@example.com'])
+        self.assertEqual({'followers': 10, 'greeting': 'Hi variable_1'}, variables['variable_1@example.com'])
+
+        user = self.User.objects.get(username='variable_2')
+        self.assertEqual(10, FollowersBatchMessage(self.drip).mailgun_variables_for_user(user)['followers'])
@@ -0,0 +1,185 @@
+import operator
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, DateTimeField
+from django.utils import timezone
+
+from drip.models import RelativeTime
+
+
+COMPARISONS = {
+    'exact': operator.eq,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+
+
+class Timeline(object):
+    """
+    Works out who gets a drip on which day of a walk over time.
+
+    Rather than querying the audience of every shifted drip, rules with a
+    relative time value are widened to cover the whole walk, so one query
+    finds every candidate. The first day each candidate becomes eligible
+    on is then worked out from the values of those time based fields.
+    """
+
+    def __init__(self, drip, into_past=0, into_future=0, page_size=None):
+        self.drip = drip
+        self.shifted_drips = drip.walk(into_past=into_past, into_future=into_future)
+        self.page_size = page_size or getattr(settings, 'DRIP_TIMELINE_PAGE_SIZE', 100)
+
+    def get_user_ids(self):
+        """
+        Returns a list of user ids for every shifted drip, each user
+        listed on the first day they would get the drip only.
+        """
+        if not self.shifted_drips:
+            return []
+
+        plan = self.drip.drip_model.get_queryset_rule_plan()
+        relative_rules = [rule for rule in plan.rules if isinstance(rule.parsed_field_value, RelativeTime)]
+        fields = [self.time_field(rule) for rule in relative_rules]
+
+        if not all(fields):
+            return self.walk_user_ids()
+        return self.window_user_ids(plan, relative_rules, fields)
+
+    def time_field(self, rule):
+        """
+        Returns the model field `rule` compares against if it can be
+        evaluated per user, that is a plain lookup on a date or datetime
+        reached through single valued relations only.
+        """
+        if rule.lookup_type not in COMPARISONS or rule.field_name.endswith('__count'):
+            return None
+
+        opts = self.drip.queryset().model._meta
+        field = None
+        for name in rule.field_name.split('__'):
+            if field is not None:
+                if not field.is_relation:
+                    return None
+                opts = field.related_model._meta
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if field.many_to_many or field.one_to_many:
+                return None
+
+        if field.is_relation:
+            return None
+        return field
+
+    def window_user_ids(self, plan, relative_rules, fields):
+        nows = [shifted_drip.now() for shifted_drip in self.shifted_drips]
+
+        # per rule, the value it compares against on every day
+        bounds = []
+        for rule, field in zip(relative_rules, fields):
+            relative = rule.parsed_field_value
+            bounds.append([self.normalize(relative.resolve(lambda: now), field) for now in nows])
+
+        filters, excludes = [], []
+        for method_type, lookup, value in plan.clauses:
+            if not isinstance(value, RelativeTime):
+                clauses = excludes if method_type == 'exclude' else filters
+                clauses.append(Q(**{lookup: value}))
+
+        # a filter on a relative time holds on some day of the walk only
+        # within the window spanned by its first and last day
+        for rule, rule_bounds in zip(relative_rules, bounds):
+            if rule.method_type == 'exclude':
+                continue
+            if rule.lookup_type in ('lt', 'lte'):
+                filters.append(Q(**{rule.lookup: rule_bounds[-1]}))
+            elif rule.lookup_type in ('gt', 'gte'):
+                filters.append(Q(**{rule.lookup: rule_bounds[0]}))
+            else:
+                filters.append(Q(**{rule.field_name + '__range': (rule_bounds[0], rule_bounds[-1])}))
+
+        qs = plan.apply_clauses(self.drip.queryset(), filters, excludes).distinct()
+        qs = self.drip.exclude_sent(qs)
+
+        user_ids = [[] for shifted_drip in self.shifted_drips]
+        field_names = [rule.field_name for rule in relative_rules]
+        for row in qs.order_by('pk').values_list('pk', *field_names):
+            day = self.first_day(row[1:], relative_rules, bounds)
+            if day is not None:
+                user_ids[day].append(row[0])
+        return user_ids
+
+    def first_day(self, values, relative_rules, bounds):
+        for day in range(len(self.shifted_drips)):
+            for value, rule, rule_bounds in zip(values, relative_rules, bounds):
+                matches = value is not None and COMPARISONS[rule.lookup_type](value, rule_bounds[day])
+                if matches == (rule.method_type == 'exclude'):
+                    break
+            else:
+                return day
+        return None
+
+    def normalize(self, value, field):
+        """
+        Casts a resolved relative time to what the database would
+        compare `field` against.
+        """
+        if isinstance(field, DateTimeField):
+            if not isinstance(value, datetime):
+                value = datetime.combine(value, time())
+                if settings.USE_TZ:
+                    value = timezone.make_aware(value, timezone.get_default_timezone())
+        elif isinstance(value, datetime):
+            if settings.USE_TZ and timezone.is_aware(value):
+                value = timezone.localtime(value, timezone.get_default_timezone())
+            value = value.date()
+        return value
+
+    def walk_user_ids(self):
+        """
+        Falls back to querying the audience of every shifted drip when
+        the rules can not be evaluated per user.
+        """
+        user_ids = []
+        seen = set()
+        for shifted_drip in self.shifted_drips:
+            shifted_drip.prune()
+            ids = [pk for pk in shifted_drip.get_queryset().order_by('pk').values_list('pk', flat=True)
+                   if pk not in seen]
+            seen.update(ids)
+            user_ids.append(ids)
+        return user_ids
+
+    def days(self, page=1):
+        """
+        Returns a dict for every shifted drip with the `page` of users
+        who first get the drip on that day, as `qs`, and the Page itself.
+        """
+        pages = []
+        for ids in self.get_user_ids():
+            paginator = Paginator(ids, self.page_size)
+            try:
+                pages.append(paginator.page(page))
+            except PageNotAnInteger:
+                pages.append(paginator.page(1))
+            except EmptyPage:
+                pages.append(paginator.page(paginator.num_pages))
+
+        # fetch the users shown on every day at once
+        shown_ids = [pk for day_page in pages for pk in day_page.object_list]
+        users = self.drip.queryset().in_bulk(shown_ids) if shown_ids else {}
+
+        days = []
+        for shifted_drip, day_page in zip(self.shifted_drips, pages):
+            days.append({
+                'drip': shifted_drip,
+                'page': day_page,
+                'qs': [users[pk] for pk in day_page.object_list if pk in users],
+            })
+        return days
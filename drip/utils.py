@@ -1,5 +1,10 @@
 import sys
+import bisect
+import operator
+import threading
+from collections import OrderedDict
 
+from django.apps import apps
 from django.db import models
 # try:
 #    from django.db.models.related import RelatedObject
@@ -114,6 +119,36 @@ def get_fields(Model,
     return out_fields
 
 
+#: get_fields(Model) of every model, keyed by full lookup path
+_field_indexes = {}
+#: ({parent path: [child paths]}, sorted paths) of every model
+_field_lookups = {}
+
+
+def get_field_index(Model):
+    """
+    Returns an OrderedDict of `get_fields(Model)` keyed by the full lookup
+    path of every field.
+
+    The relation graph is only walked once per model, as soon as the app
+    registry is ready, and again only if a model is added.
+    """
+    if not apps.ready:
+        return OrderedDict((field[0], field) for field in get_fields(Model, '', []))
+    try:
+        return _field_indexes[Model]
+    except KeyError:
+        index = _field_indexes[Model] = OrderedDict(
+            (field[0], field) for field in get_fields(Model, '', []))
+        return index
+
+
+def forget_field_indexes(**kwargs):
+    _field_indexes.clear()
+    _field_lookups.clear()
+models.signals.class_prepared.connect(forget_field_indexes)
+
+
 def give_model_field(full_field, Model):
     """
     Given a field_name and Model:
@@ -122,17 +157,126 @@ def give_model_field(full_field, Model):
 
     Returns "test_user__unique_id", "id", <Model>, <ModelField>
     """
-    field_data = get_fields(Model, '', [])
+    try:
+        full_key, name, _Model, _ModelField = get_field_index(Model)[full_field]
+    except KeyError:
+        raise Exception('Field key `{0}` not found on `{1}`.'.format(full_field, Model.__name__))
+    return full_key, name, _Model, _ModelField
 
-    for full_key, name, _Model, _ModelField in field_data:
-        if full_key == full_field:
-            return full_key, name, _Model, _ModelField
 
-    raise Exception('Field key `{0}` not found on `{1}`.'.format(full_field, Model.__name__))
+def get_simple_fields(Model, **kwargs):
+    fields = get_fields(Model, **kwargs) if kwargs else get_field_index(Model).values()
+    return [[f[0], f[3].__name__] for f in fields]
 
 
-def get_simple_fields(Model, **kwargs):
-    return [[f[0], f[3].__name__] for f in get_fields(Model, **kwargs)]
+def _get_field_lookups(Model):
+    try:
+        return _field_lookups[Model]
+    except KeyError:
+        pass
+
+    children = {}
+    for full_key in get_field_index(Model):
+        parent, _, _ = full_key.rpartition('__')
+        children.setdefault(parent, []).append(full_key)
+    lookups = (children, sorted(get_field_index(Model)))
+    if apps.ready:
+        _field_lookups[Model] = lookups
+    return lookups
+
+
+def _describe_field_paths(Model, full_keys):
+    """
+    Returns [full_key, field class name, has children] for `full_keys`.
+    """
+    index = get_field_index(Model)
+    children = _get_field_lookups(Model)[0]
+    return [[full_key, index[full_key][3].__name__, full_key in children]
+            for full_key in full_keys]
+
+
+def get_field_children(Model, parent=''):
+    """
+    Returns the fields one relation level below the `parent` lookup path,
+    see `_describe_field_paths`.
+    """
+    children = _get_field_lookups(Model)[0]
+    return _describe_field_paths(Model, children.get(parent, []))
+
+
+def search_field_paths(Model, prefix, limit=50):
+    """
+    Returns at most `limit` fields whose full lookup path starts with
+    `prefix`, see `_describe_field_paths`.
+    """
+    full_keys = _get_field_lookups(Model)[1]
+    found = []
+    for full_key in full_keys[bisect.bisect_left(full_keys, prefix):]:
+        if not full_key.startswith(prefix) or len(found) >= limit:
+            break
+        found.append(full_key)
+    return _describe_field_paths(Model, found)
+
+
+def _attribute_fields(opts):
+    """
+    Returns {attribute name: (field, query name)} for the fields and
+    reverse relations of a model.
+    """
+    fields = {}
+    for field in opts.get_fields():
+        if isinstance(field, ForeignObjectRel):
+            accessor_name = field.get_accessor_name()
+            if accessor_name:
+                fields[accessor_name] = (field, field.field.related_query_name())
+        else:
+            fields[field.name] = (field, field.name)
+    return fields
+
+
+def get_related_lookups(Model, paths):
+    """
+    Given attribute paths looked up on instances of `Model`, like
+    ('profile', 'credits') or ('groups', 'all'), returns the
+    `(select_related, prefetch_related, only)` lookups which load them
+    along with the instances.
+
+    `only` is None unless every path starts with a field, as the fields
+    a method or property needs can not be known.
+    """
+    select_related = set()
+    prefetch_related = set()
+    only = set([Model._meta.pk.name])
+
+    for path in paths:
+        if not path:
+            only = None
+
+        opts = Model._meta
+        select_path, attr_path = [], []
+        prefetching = False
+        for depth, name in enumerate(path):
+            field, query_name = _attribute_fields(opts).get(name, (None, None))
+            if field is None:
+                if depth == 0:
+                    only = None
+                break
+            if depth == 0 and only is not None and field.concrete and not field.many_to_many:
+                only.add(field.name)
+            if not field.is_relation or field.related_model is None:
+                break
+
+            attr_path.append(name)
+            if field.many_to_many or field.one_to_many:
+                prefetching = True
+            if prefetching:
+                prefetch_related.add('__'.join(attr_path))
+            else:
+                select_path.append(query_name)
+                select_related.add('__'.join(select_path))
+            opts = field.related_model._meta
+
+    return select_related, prefetch_related, only
 
 
 def get_user_model():
@@ -143,3 +287,92 @@ def get_user_model():
     except ImportError:
         from django.contrib.auth.models import User
     return User
+
+
+def queryset_pages(qs, page_size, get_pk=operator.attrgetter('pk')):
+    """
+    Yields lists of at most `page_size` objects from `qs`.
+
+    Pages are keyset paginated on the primary key, so each one is a
+    bounded query of its own no matter how deep into `qs` it is. For
+    `values_list` querysets, `get_pk` gets the primary key from a row.
+
+    One row more than a page is fetched to tell whether another page
+    follows, which saves querying an empty page after the last one.
+    """
+    qs = qs.order_by('pk')
+    last_pk = None
+    while True:
+        page_qs = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        page = list(page_qs[:page_size + 1])
+        more = len(page) > page_size
+        page = page[:page_size]
+        if page:
+            yield page
+        if not more:
+            return
+        last_pk = get_pk(page[-1])
+
+
+def iterate_queryset(qs, page_size=None, get_pk=operator.attrgetter('pk')):
+    """
+    Iterates `qs` one page at a time if `page_size` is given, else
+    evaluates it at once like a plain `for` loop would.
+    """
+    if not page_size:
+        for obj in qs:
+            yield obj
+        return
+    for page in queryset_pages(qs, page_size, get_pk):
+        for obj in page:
+            yield obj
+
+
+class LRUCache(object):
+    """
+    A small thread safe mapping which forgets the least recently used
+    key once it holds more than `maxsize` items.
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()